@@ -0,0 +1,565 @@
+import asyncio
+import bisect
+import concurrent.futures
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import sys
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows 没有 resource，峰值内存记为 None
+
+import main
+from main import (OSCILLATOR_ENGINES, Score, PITCH_BY_NAME, PITCH_FREQS, PITCH_NAMES,
+                  QUARTER_NOTE_DURATION, NullAudioBackend, PlaybackState,
+                  SAMPLE_RATE, ScoreTimeline, StreamPlayer, TIMBRES,
+                  draw_staff, generate_audio_note, iter_score_chunks,
+                  load_score, note_wave_cache, parse_score, render_batch,
+                  render_score, render_score_parallel, save_midi)
+
+# ===================== 基准测试配置 =====================
+BENCH_SCORE_SIZES = [250, 500, 1000, 2000]
+BENCH_REPEAT = 3
+
+
+# ===================== 构造测试乐谱 =====================
+def make_bench_score(note_count, seed=0, durations=(1, 2, 3, 4)):
+    rng = np.random.default_rng(seed)
+    # config.txt 常用音域 C3~G5 加休止符
+    note_codes = [PITCH_BY_NAME['R']] + list(
+        range(PITCH_BY_NAME['C3'], PITCH_BY_NAME['G5'] + 1))
+    return Score.from_arrays(
+        np.array(note_codes)[rng.integers(len(note_codes), size=note_count)],
+        np.array(durations)[rng.integers(len(durations), size=note_count)])
+
+
+# ===================== 旧实现：逐音符 np.append =====================
+def render_score_append(notes):
+    total_audio = np.array([], dtype=np.int16)
+    for note_code, dur_mult in notes:
+        note_audio = generate_audio_note(PITCH_FREQS[note_code],
+                                         dur_mult * QUARTER_NOTE_DURATION)
+        total_audio = np.append(total_audio, note_audio)
+    return total_audio
+
+
+def best_time(render_func, notes):
+    best = float('inf')
+    for _ in range(BENCH_REPEAT):
+        note_wave_cache.clear()  # 每轮都从冷缓存开始，比较合成本身
+        start = time.perf_counter()
+        render_func(notes)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+# ===================== 整曲合成：耗时随乐谱长度的增长 =====================
+def bench_render_scaling(sizes=BENCH_SCORE_SIZES):
+    print(f"{'音符数':>8} | {'np.append(s)':>12} | {'预分配(s)':>10} | "
+          f"{'append μs/音符':>14} | {'预分配 μs/音符':>14}")
+    for note_count in sizes:
+        notes = make_bench_score(note_count)
+        append_time = best_time(render_score_append, notes)
+        prealloc_time = best_time(render_score, [notes])
+        print(f"{note_count:>8} | {append_time:>12.4f} | {prealloc_time:>10.4f} | "
+              f"{append_time / note_count * 1e6:>14.1f} | "
+              f"{prealloc_time / note_count * 1e6:>14.1f}")
+
+
+# ===================== 首块出声时间：整曲合成 vs 流式合成 =====================
+def bench_first_chunk_latency(sizes=BENCH_SCORE_SIZES):
+    print(f"{'音符数':>8} | {'整曲合成(ms)':>12} | {'流式首块(ms)':>12}")
+    for note_count in sizes:
+        notes = make_bench_score(note_count)
+        note_wave_cache.clear()
+        start = time.perf_counter()
+        render_score([notes])
+        full_time = time.perf_counter() - start
+
+        note_wave_cache.clear()
+        start = time.perf_counter()
+        next(iter_score_chunks([notes]))
+        first_chunk_time = time.perf_counter() - start
+        print(f"{note_count:>8} | {full_time * 1e3:>12.1f} | "
+              f"{first_chunk_time * 1e3:>12.2f}")
+
+
+# ===================== 音符波形缓存：冷启动 vs 命中 =====================
+def bench_note_cache(sizes=BENCH_SCORE_SIZES):
+    print(f"{'音符数':>8} | {'冷缓存(ms)':>10} | {'热缓存(ms)':>10} | {'命中':>8} | "
+          f"{'未命中':>6} | {'淘汰':>6}")
+    for note_count in sizes:
+        notes = make_bench_score(note_count)
+        note_wave_cache.clear()
+        start = time.perf_counter()
+        for _ in iter_score_chunks([notes]):
+            pass
+        cold_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in iter_score_chunks([notes]):
+            pass
+        warm_time = time.perf_counter() - start
+        stats = note_wave_cache.stats()
+        print(f"{note_count:>8} | {cold_time * 1e3:>10.1f} | "
+              f"{warm_time * 1e3:>10.1f} | {stats['hits']:>8} | "
+              f"{stats['misses']:>6} | {stats['evictions']:>6}")
+
+
+# ===================== 振荡器引擎：合成吞吐量 =====================
+def bench_oscillator_engines(note_dur=1.0, note_count=200):
+    note_freqs = [freq for freq in PITCH_FREQS if freq > 0]
+    print(f"{'引擎':>10} | {'音色':>8} | {'采样/秒':>14} | {'实时倍数':>8}")
+    for engine_name, oscillator in OSCILLATOR_ENGINES.items():
+        for timbre in TIMBRES:
+            start = time.perf_counter()
+            for idx in range(note_count):
+                oscillator(note_freqs[idx % len(note_freqs)], note_dur, timbre)
+            elapsed = time.perf_counter() - start
+            samples_per_sec = note_count * int(SAMPLE_RATE * note_dur) / elapsed
+            print(f"{engine_name:>10} | {timbre:>8} | {samples_per_sec:>14,.0f} | "
+                  f"{samples_per_sec / SAMPLE_RATE:>8.0f}")
+
+
+# ===================== 多音轨混音：四声部 vs 四次单声部 =====================
+def make_bench_arrangement(note_count, voice_count=4):
+    # 旋律 + 三和弦伴奏的四声部编排，每个声部的音符数相同
+    melody = make_bench_score(note_count, seed=0)
+    chord_count = voice_count - 1
+    rng = np.random.default_rng(voice_count)
+    roots = rng.integers(48, 72, size=note_count)
+    chord_voices = roots[:, None] + np.array([0, 4, 7])[:chord_count]
+    chords = Score.from_arrays(chord_voices[:, 0],
+                               make_bench_score(note_count,
+                                                seed=voice_count).durations,
+                               chord_voices[:, 1:].astype(np.uint8))
+    return [melody, chords]
+
+
+def bench_mixer(sizes=BENCH_SCORE_SIZES):
+    print(f"{'音符数':>8} | {'4次单声部(ms)':>14} | {'四声部混音(ms)':>14} | {'比值':>6}")
+    for note_count in sizes:
+        melody, chords = make_bench_arrangement(note_count)
+        chord_pitches = np.column_stack(
+            [chords.pitches, chords.events['chord']])
+        voices = [melody] + [
+            Score.from_arrays(chord_pitches[:, i], chords.durations)
+            for i in range(3)
+        ]
+        mono_time = sum(best_time(render_score, [voice]) for voice in voices)
+        mix_time = best_time(render_score, [melody, chords])
+        print(f"{note_count:>8} | {mono_time * 1e3:>14.1f} | "
+              f"{mix_time * 1e3:>14.1f} | {mix_time / mono_time:>6.2f}")
+
+
+# ===================== 包络开销：开/关 ADSR 的整曲渲染耗时 =====================
+def bench_envelope_overhead(sizes=BENCH_SCORE_SIZES):
+    print(f"{'音符数':>8} | {'无包络(ms)':>10} | {'有包络(ms)':>10} | {'额外开销':>8}")
+    adsr = main.ENVELOPE_ADSR or (0.005, 0.05, 0.8, 0.03)
+    for note_count in sizes:
+        notes = make_bench_score(note_count)
+        main.ENVELOPE_ADSR = None
+        plain_time = best_time(render_score, [notes])
+        main.ENVELOPE_ADSR = adsr
+        envelope_time = best_time(render_score, [notes])
+        print(f"{note_count:>8} | {plain_time * 1e3:>10.1f} | "
+              f"{envelope_time * 1e3:>10.1f} | "
+              f"{(envelope_time / plain_time - 1) * 100:>7.1f}%")
+
+
+# ===================== 多进程合成：找出并行开始划算的乐谱长度 =====================
+PARALLEL_BENCH_SIZES = [500, 2000, 8000, 32000]
+
+
+def bench_parallel_crossover(sizes=PARALLEL_BENCH_SIZES, workers=None):
+    workers = workers or os.cpu_count()
+    min_samples = main.PARALLEL_MIN_SAMPLES
+    main.PARALLEL_MIN_SAMPLES = 0  # 测量时关闭长度门槛
+    print(f"并行进程数：{workers}")
+    print(f"{'音符数':>8} | {'音频(秒)':>8} | {'单进程(ms)':>10} | "
+          f"{'多进程(ms)':>10} | {'加速比':>6}")
+    crossover = None
+    try:
+        for note_count in sizes:
+            tracks = make_bench_arrangement(note_count)
+            audio_seconds = len(render_score(tracks)[0]) / SAMPLE_RATE
+            serial_time = best_time(render_score, tracks)
+            parallel_time = best_time(
+                lambda tracks: render_score_parallel(tracks, workers), tracks)
+            speedup = serial_time / parallel_time
+            if crossover is None and speedup > 1:
+                crossover = audio_seconds
+            print(f"{note_count:>8} | {audio_seconds:>8.0f} | "
+                  f"{serial_time * 1e3:>10.1f} | {parallel_time * 1e3:>10.1f} | "
+                  f"{speedup:>6.2f}")
+    finally:
+        main.PARALLEL_MIN_SAMPLES = min_samples
+    if crossover is None:
+        print("并行在以上长度内均不划算")
+    else:
+        print(f"约 {crossover:.0f} 秒音频起并行开始划算，"
+              f"可据此设置 PARALLEL_MIN_SAMPLES = SAMPLE_RATE * {crossover:.0f}")
+
+
+# ===================== 批量渲染：吞吐量随进程数的变化 =====================
+def write_bench_score(score_path, notes):
+    with open(score_path, "w", encoding="utf-8") as f:
+        for note_code, dur in notes:
+            f.write(f"('{PITCH_NAMES[note_code]}', {dur})\n")
+
+
+def bench_batch_scaling(score_count=16, note_count=2000, worker_counts=None):
+    worker_counts = worker_counts or sorted({1, 2, 4, os.cpu_count()})
+    score_dir = tempfile.mkdtemp(prefix="bench_scores_")
+    try:
+        for idx in range(score_count):
+            write_bench_score(os.path.join(score_dir, f"score_{idx}.txt"),
+                              make_bench_score(note_count, seed=idx))
+        print(f"{'进程数':>6} | {'用时(s)':>8} | {'音频秒/秒':>10} | {'相对1进程':>8}")
+        base_throughput = None
+        for workers in worker_counts:
+            output_dir = os.path.join(score_dir, f"out_{workers}")
+            manifest = render_batch(score_dir, output_dir, workers)
+            throughput = manifest['rendered_audio_seconds'] / manifest[
+                'wall_seconds']
+            base_throughput = base_throughput or throughput
+            print(f"{workers:>6} | {manifest['wall_seconds']:>8.2f} | "
+                  f"{throughput:>10.0f} | {throughput / base_throughput:>8.2f}")
+    finally:
+        shutil.rmtree(score_dir)
+
+
+# ===================== 乐谱解析：逐行 eval vs 专用解析器 =====================
+def eval_score_lines(lines):
+    # 旧实现：每行 eval 一次
+    return [
+        eval(line.strip()) for line in lines
+        if line.strip() and line.strip().startswith("(")
+    ]
+
+
+def bench_parser(note_counts=(10000, 100000, 300000)):
+    print(f"{'音符数':>8} | {'大小(MB)':>8} | {'eval(s)':>8} | {'解析器(s)':>9} | {'加速比':>6}")
+    for note_count in note_counts:
+        score = make_bench_score(note_count)
+        lines = [f"('{PITCH_NAMES[note_code]}', {dur:g})\n"
+                 for note_code, dur in score]
+        size_mb = sum(len(line) for line in lines) / 1e6
+
+        start = time.perf_counter()
+        eval_score_lines(lines)
+        eval_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        parse_score(lines)
+        parse_time = time.perf_counter() - start
+        print(f"{note_count:>8} | {size_mb:>8.2f} | {eval_time:>8.3f} | "
+              f"{parse_time:>9.3f} | {eval_time / parse_time:>6.1f}")
+
+
+# ===================== MIDI 导入：耗时随音符数的增长 =====================
+def bench_midi_import(note_counts=(1000, 10000, 100000), track_count=2):
+    print(f"{'音符数':>8} | {'大小(KB)':>8} | {'导入(ms)':>8} | {'音符/秒':>10}")
+    midi_dir = tempfile.mkdtemp(prefix="bench_midi_")
+    try:
+        for note_count in note_counts:
+            midi_path = os.path.join(midi_dir, f"{note_count}.mid")
+            save_midi([make_bench_score(note_count // track_count, seed)
+                       for seed in range(track_count)], midi_path)
+            best = float('inf')
+            for _ in range(BENCH_REPEAT):
+                start = time.perf_counter()
+                load_score(midi_path)
+                best = min(best, time.perf_counter() - start)
+            size_kb = os.path.getsize(midi_path) / 1e3
+            print(f"{note_count:>8} | {size_kb:>8.1f} | {best * 1e3:>8.1f} | "
+                  f"{note_count / best:>10.0f}")
+    finally:
+        shutil.rmtree(midi_dir)
+
+
+# ===================== 同步循环：线性累加 vs 二分查找当前音符 =====================
+def bench_sync_lookup(note_counts=(1000, 10000, 100000), tick_count=200):
+    print(f"{'音符数':>8} | {'线性(us/次)':>11} | {'二分(us/次)':>11}")
+    for note_count in note_counts:
+        score = make_bench_score(note_count)
+        note_durations = score.seconds.tolist()
+        note_offsets = score.offsets.tolist()
+        total_seconds = score.end_sample / SAMPLE_RATE
+        ticks = np.linspace(0, total_seconds, tick_count, endpoint=False)
+
+        start = time.perf_counter()
+        for elapsed_time in ticks.tolist():
+            # 旧实现：每次从头累加，并重新求总时长
+            accum_dur = 0
+            for idx, dur in enumerate(note_durations):
+                accum_dur += dur
+                if elapsed_time < accum_dur:
+                    break
+            sum(note_durations)
+        linear_time = (time.perf_counter() - start) / tick_count
+
+        start = time.perf_counter()
+        for elapsed_time in ticks.tolist():
+            bisect.bisect_right(note_offsets, int(elapsed_time * SAMPLE_RATE))
+        bisect_time = (time.perf_counter() - start) / tick_count
+        print(f"{note_count:>8} | {linear_time * 1e6:>11.1f} | "
+              f"{bisect_time * 1e6:>11.2f}")
+
+
+# ===================== 五线谱重画：整块重写 vs 差分渲染（每帧字节数） =====================
+def draw_staff_full(state, playing_idx):
+    # 旧实现：每帧重写全部五线谱行，再画音符和进度行
+    music_notes, term_width = state.notes, state.term_width
+    first_row = main.fixed_lines['staff_start'] + 2
+    for i in range(main.STAFF_TOTAL_LINES):
+        sys.stdout.write(f"\033[{first_row + i};1H")
+        sys.stdout.write((main.STAFF_LINE_CHAR if i in main.STAFF_LINE_ROWS
+                          else " ") * term_width)
+    start_idx = max(0, playing_idx - main.CUSTOM_DISPLAY_RANGE)
+    end_idx = min(len(music_notes), playing_idx + main.CUSTOM_DISPLAY_RANGE + 1)
+    base_col = term_width // 2 - (playing_idx - start_idx) * main.CUSTOM_NOTE_WIDTH
+    for note_idx, pitch in enumerate(
+            music_notes[start_idx:end_idx].pitches.tolist(), start_idx):
+        note_col = base_col + (note_idx - start_idx) * main.CUSTOM_NOTE_WIDTH
+        if 0 < note_col < term_width - main.CUSTOM_NOTE_WIDTH:
+            sys.stdout.write(
+                f"\033[{first_row + main.PITCH_STAFF_ROWS[pitch]};{note_col}H")
+            note_text = main.PITCH_SYMBOLS[pitch] * main.CUSTOM_NOTE_WIDTH
+            sys.stdout.write(f"\033[31m{note_text}\033[0m"
+                             if note_idx == playing_idx else note_text)
+    progress_text = (f"播放进度：{playing_idx + 1}/{len(music_notes)} | 打字机：运行中")
+    progress_row = main.fixed_lines['progress']
+    sys.stdout.write(f"\033[{progress_row};1H" + " " * term_width)
+    sys.stdout.write(f"\033[{progress_row};"
+                     f"{(term_width - len(progress_text)) // 2}H{progress_text}")
+    sys.stdout.flush()
+
+
+def bench_staff_renderer(widths=(80, 200), frame_count=500):
+    print(f"{'终端宽度':>8} | {'整块重写(B/帧)':>14} | {'差分(B/帧)':>10} | "
+          f"{'整块(us/帧)':>11} | {'差分(us/帧)':>11}")
+    notes = make_bench_score(frame_count + 50)
+    for width in widths:
+        state = PlaybackState([notes])
+        state.term_width = width
+        screen = main.staff_screen(width)
+        full_out, diff_out = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(io.StringIO()):
+            draw_staff(state, screen, 0, True, False)  # 第一帧整块画，不计入
+
+        with contextlib.redirect_stdout(full_out):
+            start = time.perf_counter()
+            for note_idx in range(1, frame_count + 1):
+                draw_staff_full(state, note_idx)
+            full_time = (time.perf_counter() - start) / frame_count
+        with contextlib.redirect_stdout(diff_out):
+            start = time.perf_counter()
+            for note_idx in range(1, frame_count + 1):
+                draw_staff(state, screen, note_idx, True, False)
+            diff_time = (time.perf_counter() - start) / frame_count
+
+        full_bytes = len(full_out.getvalue().encode("utf-8")) / frame_count
+        diff_bytes = len(diff_out.getvalue().encode("utf-8")) / frame_count
+        print(f"{width:>8} | {full_bytes:>14.0f} | {diff_bytes:>10.0f} | "
+              f"{full_time * 1e6:>11.1f} | {diff_time * 1e6:>11.1f}")
+
+
+# ===================== 播放基准套件：合成吞吐、首次出声、同步循环CPU（结果存JSON） =====================
+PLAYBACK_BENCH_SIZES = [100, 10000, 1000000]
+PLAYBACK_BENCH_BEATS = (1 / 16, 1 / 8, 1 / 4)  # 短音符：百万音符约10小时音频，合成不至于太久
+PLAYBACK_BENCH_WINDOW = 3.0  # 同步循环CPU的测量时长（秒，无声后端按实时速率播放）
+BENCH_RESULTS_DIR = "music/bench_results"
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Linux 单位是KB
+
+
+def git_commit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+async def run_sync_window(state, player, window_seconds):
+    # 同步循环 + 五线谱 + 打字机照常运行 window_seconds 秒后取消
+    try:
+        await asyncio.wait_for(main.play_song(state, player, True),
+                               window_seconds)
+    except asyncio.TimeoutError:
+        pass
+
+
+def playback_bench_worker(note_count, window_seconds):
+    # 在独立进程里跑一档，峰值内存只算这一档
+    score = make_bench_score(note_count, durations=PLAYBACK_BENCH_BEATS)
+    lines = [f"('{PITCH_NAMES[note_code]}', {dur:g})\n"
+             for note_code, dur in score]
+
+    # 首次出声：从解析乐谱文本到第一块送进输出后端
+    start = time.perf_counter()
+    tracks = parse_score(lines)
+    state = PlaybackState(tracks)
+    player = StreamPlayer(ScoreTimeline(tracks), clock=state.clock,
+                          backend=NullAudioBackend())
+    player.start()
+    first_sound_time = time.perf_counter() - start
+
+    # 同步循环CPU：事件循环线程的CPU时间 / 墙钟时间（合成、送声线程不计）
+    with open(os.devnull, "w", encoding="utf-8") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        cpu_start, wall_start = time.thread_time(), time.perf_counter()
+        asyncio.run(run_sync_window(state, player, window_seconds))
+        sync_cpu_time = time.thread_time() - cpu_start
+        sync_wall_time = time.perf_counter() - wall_start
+    player.close()
+
+    # 合成吞吐：冷缓存下逐块合成整曲（不保留整曲PCM）
+    note_wave_cache.clear()
+    start = time.perf_counter()
+    total_samples = sum(len(chunk) for chunk in iter_score_chunks(tracks))
+    synth_time = time.perf_counter() - start
+    audio_seconds = total_samples / SAMPLE_RATE
+    return {
+        'notes': note_count,
+        'audio_seconds': audio_seconds,
+        'synth_seconds': synth_time,
+        'samples_per_second': total_samples / synth_time,
+        'realtime_factor': audio_seconds / synth_time,
+        'time_to_first_sound_seconds': first_sound_time,
+        'sync_loop_cpu_seconds': sync_cpu_time,
+        'sync_loop_cpu_percent': sync_cpu_time / sync_wall_time * 100,
+        'underruns': player.metrics()['underruns'],
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+
+def bench_playback_suite(sizes=PLAYBACK_BENCH_SIZES, output_path=None,
+                         window_seconds=PLAYBACK_BENCH_WINDOW):
+    print(f"{'音符数':>8} | {'音频(秒)':>9} | {'采样/秒':>13} | {'实时倍数':>8} | "
+          f"{'首次出声(ms)':>12} | {'同步CPU':>7} | {'峰值内存(MB)':>12}")
+    spawn = multiprocessing.get_context("spawn")
+    results = []
+    for note_count in sizes:
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=spawn) as pool:
+            result = pool.submit(playback_bench_worker, note_count,
+                                 window_seconds).result()
+        results.append(result)
+        peak_rss = ("-" if result['peak_rss_bytes'] is None else
+                    f"{result['peak_rss_bytes'] / 1e6:.0f}")
+        print(f"{note_count:>8} | {result['audio_seconds']:>9.0f} | "
+              f"{result['samples_per_second']:>13,.0f} | "
+              f"{result['realtime_factor']:>8.0f} | "
+              f"{result['time_to_first_sound_seconds'] * 1e3:>12.1f} | "
+              f"{result['sync_loop_cpu_percent']:>6.1f}% | {peak_rss:>12}")
+
+    report = {
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'cpu_count': os.cpu_count(),
+        'sample_rate': SAMPLE_RATE,
+        'synth_engine': main.SYNTH_ENGINE,
+        'note_beats': list(PLAYBACK_BENCH_BEATS),
+        'sync_window_seconds': window_seconds,
+        'results': results,
+    }
+    if output_path is None:
+        output_path = os.path.join(
+            BENCH_RESULTS_DIR,
+            f"playback_{time.strftime('%Y%m%d_%H%M%S')}_{report['commit']}.json")
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存：{output_path}")
+    return report
+
+
+PLAYBACK_COMPARE_METRICS = [
+    ('samples_per_second', '采样/秒', True),
+    ('time_to_first_sound_seconds', '首次出声', False),
+    ('sync_loop_cpu_percent', '同步CPU', False),
+    ('peak_rss_bytes', '峰值内存', False),
+]
+
+
+def compare_playback_results(old_path, new_path):
+    # 两次套件结果逐档对比：新/旧 的比值（采样/秒越大越好，其余越小越好）
+    with open(old_path, "r", encoding="utf-8") as f:
+        old_report = json.load(f)
+    with open(new_path, "r", encoding="utf-8") as f:
+        new_report = json.load(f)
+    print(f"{old_report['commit']} → {new_report['commit']}")
+    print(f"{'音符数':>8} | " + " | ".join(
+        f"{label:>8}" for _, label, _ in PLAYBACK_COMPARE_METRICS))
+    old_results = {result['notes']: result for result in old_report['results']}
+    for new_result in new_report['results']:
+        old_result = old_results.get(new_result['notes'])
+        if old_result is None:
+            continue
+        cells = []
+        for key, _, _ in PLAYBACK_COMPARE_METRICS:
+            if old_result[key] and new_result[key] is not None:
+                cells.append(f"{new_result[key] / old_result[key]:>7.2f}x")
+            else:
+                cells.append(f"{'-':>8}")
+        print(f"{new_result['notes']:>8} | " + " | ".join(cells))
+
+
+if __name__ == "__main__":
+    # 用法：python music/bench.py [音符数 ...]
+    #       python music/bench.py suite [结果JSON]      只跑播放基准套件
+    #       python music/bench.py compare 旧.json 新.json
+    if sys.argv[1:2] == ["suite"]:
+        bench_playback_suite(output_path=(sys.argv[2]
+                                          if len(sys.argv) > 2 else None))
+        sys.exit(0)
+    if sys.argv[1:2] == ["compare"]:
+        compare_playback_results(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+    sizes = [int(arg) for arg in sys.argv[1:]] or BENCH_SCORE_SIZES
+    bench_render_scaling(sizes)
+    print()
+    bench_first_chunk_latency(sizes)
+    print()
+    bench_note_cache(sizes)
+    print()
+    bench_oscillator_engines()
+    print()
+    bench_mixer(sizes)
+    print()
+    bench_envelope_overhead(sizes)
+    print()
+    bench_parallel_crossover()
+    print()
+    bench_batch_scaling()
+    print()
+    bench_parser()
+    print()
+    bench_midi_import()
+    print()
+    bench_sync_lookup()
+    print()
+    bench_staff_renderer()
+    print()
+    bench_playback_suite()
@@ -1,199 +1,159 @@
 import numpy as np
-import simpleaudio as sa
 import threading
+from collections import OrderedDict
+from array import array
+import argparse
+import asyncio
+import atexit
+import bisect
+import errno
+import concurrent.futures
+import glob
+import itertools
+import hashlib
+import json
+import multiprocessing
+import re
+import signal
+import struct
+import tempfile
+from multiprocessing import shared_memory
+import wave
 import time
 import os
 import sys
-
-# ===================== 核心配置：音符→五线谱位置映射（单个字符） =====================
-NOTE_POSITION_MAP = {
-    # 低音区（3组）
-    'C3': {
-        'symbol': '♩',
-        'pos': 1
-    },
-    'C#3': {
-        'symbol': '♯',
-        'pos': 1
-    },
-    'D3': {
-        'symbol': '♩',
-        'pos': 2
-    },
-    'D#3': {
-        'symbol': '♯',
-        'pos': 2
-    },
-    'E3': {
-        'symbol': '♩',
-        'pos': 3
-    },
-    'F3': {
-        'symbol': '♩',
-        'pos': 4
-    },
-    'F#3': {
-        'symbol': '♯',
-        'pos': 4
-    },
-    'G3': {
-        'symbol': '♩',
-        'pos': 5
-    },
-    'G#3': {
-        'symbol': '♯',
-        'pos': 5
-    },
-    'A3': {
-        'symbol': '♩',
-        'pos': 5
-    },
-    'A#3': {
-        'symbol': '♯',
-        'pos': 5
-    },
-    'B3': {
-        'symbol': '♩',
-        'pos': 6
-    },
-    # 中音区（4组）
-    'C4': {
-        'symbol': '♪',
-        'pos': 5
-    },
-    'C#4': {
-        'symbol': '♭',
-        'pos': 5
-    },
-    'D4': {
-        'symbol': '♪',
-        'pos': 6
-    },
-    'D#4': {
-        'symbol': '♭',
-        'pos': 6
-    },
-    'E4': {
-        'symbol': '♪',
-        'pos': 7
-    },
-    'F4': {
-        'symbol': '♪',
-        'pos': 8
-    },
-    'F#4': {
-        'symbol': '♭',
-        'pos': 8
-    },
-    'G4': {
-        'symbol': '♪',
-        'pos': 7
-    },
-    'G#4': {
-        'symbol': '♭',
-        'pos': 7
-    },
-    'A4': {
-        'symbol': '♪',
-        'pos': 8
-    },
-    'A#4': {
-        'symbol': '♭',
-        'pos': 8
-    },
-    'B4': {
-        'symbol': '♪',
-        'pos': 9
-    },
-    # 高音区（5组）
-    'C5': {
-        'symbol': '♫',
-        'pos': 7
-    },
-    'C#5': {
-        'symbol': '♮',
-        'pos': 7
-    },
-    'D5': {
-        'symbol': '♫',
-        'pos': 8
-    },
-    'D#5': {
-        'symbol': '♮',
-        'pos': 8
-    },
-    'E5': {
-        'symbol': '♫',
-        'pos': 9
-    },
-    'F5': {
-        'symbol': '♫',
-        'pos': 9
-    },
-    'F#5': {
-        'symbol': '♮',
-        'pos': 9
-    },
-    'G5': {
-        'symbol': '♫',
-        'pos': 9
-    },
-    # 休止符
-    'R': {
-        'symbol': ' ',
-        'pos': 5
-    }
-}
-
-# 音符频率映射
-NOTE_FREQS = {
-    'C3': 130.81,
-    'C#3': 138.59,
-    'D3': 146.83,
-    'D#3': 155.56,
-    'E3': 164.81,
-    'F3': 174.61,
-    'F#3': 185.00,
-    'G3': 196.00,
-    'G#3': 207.65,
-    'A3': 220.00,
-    'A#3': 233.08,
-    'B3': 246.94,
-    'C4': 261.63,
-    'C#4': 277.18,
-    'D4': 293.66,
-    'D#4': 311.13,
-    'E4': 329.63,
-    'F4': 349.23,
-    'F#4': 369.99,
-    'G4': 392.00,
-    'G#4': 415.30,
-    'A4': 440.00,
-    'A#4': 466.16,
-    'B4': 493.88,
-    'C5': 523.25,
-    'C#5': 554.37,
-    'D5': 587.33,
-    'D#5': 622.25,
-    'E5': 659.25,
-    'F5': 698.46,
-    'F#5': 739.99,
-    'G5': 783.99,
-    'R': 0.0
-}
+import unicodedata
+
+try:
+    import simpleaudio as sa
+except ImportError:
+    sa = None  # 无声卡/未安装时仍可离线渲染（render 命令）
+try:
+    import termios
+    import tty
+except ImportError:
+    termios = tty = None  # Windows：键盘控制改用 msvcrt
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
 
 # 基础参数
+DEFAULT_SCORE_PATH = "music/config.txt"
+DEFAULT_PLAYBACK_WAV_PATH = "music/playback.wav"  # --audio wav 的默认输出
+SCORE_CACHE_ENABLED = True  # 缓存编译后的乐谱和整曲PCM，再次启动时跳过解析与合成
+SCORE_CACHE_DIR = "music/.score_cache"
+SCORE_CACHE_VERSION = 2  # 合成算法或乐谱格式变化时加1，使旧缓存失效
 SAMPLE_RATE = 44100
-QUARTER_NOTE_DURATION = 0.25
+DEFAULT_TEMPO_BPM = 240  # 每分钟的拍数（时值1=一拍）；乐谱里可用 @tempo 改变
+QUARTER_NOTE_DURATION = 60 / DEFAULT_TEMPO_BPM  # 默认速度下一拍的秒数
 STAFF_TOTAL_LINES = 11  # 5线+4间+上下留白
 STAFF_LINE_ROWS = [1, 3, 5, 7, 9]  # 五线谱横线位置
 STAFF_LINE_CHAR = "—"
 STAFF_GAP_CHAR = " "
 POSITION_TO_ROW = {9: 1, 8: 2, 7: 3, 6: 4, 5: 5, 4: 6, 3: 7, 2: 8, 1: 9}
 
+# ===================== 音高表：按MIDI编号索引（覆盖钢琴88键） =====================
+# 音名只在读取乐谱时解析一次为整数MIDI编号，之后频率/五线谱位置/符号都是数组下标
+REST_PITCH = 0  # 休止符占用MIDI 0（在钢琴音域之外）
+PIANO_LOWEST_PITCH = 21  # A0
+PIANO_HIGHEST_PITCH = 108  # C8
+PITCH_CLASS_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+PITCH_CLASS_FLATS = {'C#': 'Db', 'D#': 'Eb', 'F#': 'Gb', 'G#': 'Ab', 'A#': 'Bb'}
+PITCH_CLASS_STEPS = [0, 0, 1, 1, 2, 3, 3, 4, 4, 5, 5, 6]  # 半音→自然音级（C=0…B=6）
+STAFF_BOTTOM_STEP = 4 * 7 + 2  # 五线谱最下一线（位置1）为E4
+# 各八度组的音符符号：(自然音, 变化音)；3组以下同3组，5组以上同5组
+OCTAVE_SYMBOLS = {3: ('♩', '♯'), 4: ('♪', '♭'), 5: ('♫', '♮')}
+REST_SYMBOL = ' '
+REST_POSITION = 5
+
+
+def build_pitch_tables():
+    pitches = np.arange(128)
+    octaves = pitches // 12 - 1
+    pitch_classes = pitches % 12
+    in_piano = (pitches >= PIANO_LOWEST_PITCH) & (pitches <= PIANO_HIGHEST_PITCH)
+
+    # 十二平均律，A4(69)=440Hz
+    freqs = np.where(in_piano, 440.0 * 2.0**((pitches - 69) / 12), 0.0)
+
+    # 五线谱位置：按自然音级从E4=1往上数，超出1~9的按八度折回谱表内
+    positions = octaves * 7 + np.array(PITCH_CLASS_STEPS)[pitch_classes] \
+        - STAFF_BOTTOM_STEP + 1
+    positions = np.where(positions > 9,
+                         positions - 7 * np.ceil((positions - 9) / 7),
+                         positions)
+    positions = np.where(positions < 1,
+                         positions + 7 * np.ceil((1 - positions) / 7),
+                         positions).astype(int)
+    positions[REST_PITCH] = REST_POSITION
+    staff_rows = np.array([POSITION_TO_ROW[pos] for pos in positions])
+
+    symbols = np.array([
+        OCTAVE_SYMBOLS[min(max(octave, 3), 5)][int('#' in PITCH_CLASS_NAMES[
+            pitch_class])] for octave, pitch_class in zip(octaves, pitch_classes)
+    ])
+    symbols[REST_PITCH] = REST_SYMBOL
+
+    names = [
+        f"{PITCH_CLASS_NAMES[pitch_class]}{octave}"
+        for octave, pitch_class in zip(octaves, pitch_classes)
+    ]
+    names[REST_PITCH] = 'R'
+    return freqs, staff_rows, symbols, names
+
+
+PITCH_FREQS, PITCH_STAFF_ROWS, PITCH_SYMBOLS, PITCH_NAMES = build_pitch_tables()
+
+# 音名→MIDI编号（钢琴音域内的升号/降号写法 + 休止符R）
+PITCH_BY_NAME = {'R': REST_PITCH}
+for _pitch in range(PIANO_LOWEST_PITCH, PIANO_HIGHEST_PITCH + 1):
+    PITCH_BY_NAME[PITCH_NAMES[_pitch]] = _pitch
+    _pitch_class_name = PITCH_CLASS_NAMES[_pitch % 12]
+    if _pitch_class_name in PITCH_CLASS_FLATS:
+        PITCH_BY_NAME[PITCH_CLASS_FLATS[_pitch_class_name] +
+                      str(_pitch // 12 - 1)] = _pitch
+
+
+def parse_pitch(note_name):
+    try:
+        return PITCH_BY_NAME[note_name]
+    except (KeyError, TypeError):
+        raise ValueError(f"未知音符「{note_name}」") from None
+
+
 # 自定义配置
 CUSTOM_NOTE_WIDTH = 4  # 音符宽度（列数）
 CUSTOM_DISPLAY_RANGE = 10  # 传送带前后音符数量
+
+# 流式播放配置
+STREAM_PLAYBACK = True  # True=边合成边播放，False=整曲合成完再播放
+STREAM_CHUNK_SAMPLES = 8192  # 每个PCM块的采样数（约0.19秒）
+STREAM_LATENCY_SECONDS = 0.4  # 合成与输出之间环形缓冲区的容量（秒），机器慢就调大
+STREAM_KEEP_CHUNKS = 64  # 不写缓存时每首最多留在内存里的已合成块数（约12秒，LRU），回跳更远就重新合成
+
+# 音符波形缓存配置
+NOTE_CACHE_MAX_BYTES = 32 * 1024 * 1024  # 缓存总字节上限（按LRU淘汰）
+
+# 振荡器配置
+SYNTH_ENGINE = 'wavetable'  # 'wavetable'=波表查表（快），'sine'=逐采样np.sin叠加谐波
+SYNTH_TIMBRE = 'default'  # 当前音色（见 TIMBRES）
+WAVETABLE_BITS = 12  # 单周期波表长度 = 2**WAVETABLE_BITS
+# 音色：[(谐波次数, 振幅), ...]
+TIMBRES = {
+    'default': [(1, 0.7), (2, 0.2), (3, 0.1)],
+    'pure': [(1, 1.0)],
+    'bright': [(1, 0.5), (2, 0.25), (3, 0.15), (4, 0.1)],
+    'hollow': [(1, 0.6), (3, 0.3), (5, 0.1)],
+}
+
+# 包络配置：(起音秒, 衰减秒, 持续幅度, 释音秒)，设为 None 关闭包络
+ENVELOPE_ADSR = (0.005, 0.05, 0.8, 0.03)
+ENVELOPE_CACHE_MAX_ENTRIES = 64  # 包络缓存最多保留的长度种数
+
+# 多进程合成配置
+PARALLEL_WORKERS = 0  # 整曲合成的进程数，0/1=单进程，None=全部CPU核
+PARALLEL_MIN_SAMPLES = SAMPLE_RATE * 60  # 短于此长度（采样数）时进程开销不划算，仍单进程
 # ===================== 打字机核心配置（关键修复） =====================
 TYPEWRITER_TEXT = """
 《音乐随想》
@@ -207,14 +167,8 @@ TYPEWRITER_SPEED = 0.12  # 打字速度（秒/字符），0.12=舒适节奏
 TYPEWRITER_COLOR = "\033[36m"  # 青色文本（醒目且不与音符冲突）
 TYPEWRITER_ROW_START = 1  # 打字机文本起始行（终端最顶部第1行）
 
-# ===================== 全局变量 =====================
-current_note_idx = 0
-music_notes = []
-is_playing_flag = False
-term_width = 80
-# 打字机控制变量
-is_typing_flag = False
-typed_lines = []  # 存储已打印的每一行文本（用于保留）
+# ===================== 界面布局 =====================
+# 播放过程中会变化的状态（当前音符、播放/打字标志等）都在 PlaybackState 里
 total_typewriter_lines = TYPEWRITER_TEXT.count('\n')  # 打字机文本总行数
 
 # 固定区域行号（关键调整：打字机在最顶，五线谱在下方）
@@ -223,21 +177,31 @@ fixed_lines = {
     TYPEWRITER_ROW_START + total_typewriter_lines - 1,  # 打字机结束行
     'staff_start':
     TYPEWRITER_ROW_START + total_typewriter_lines + 1,  # 五线谱开始行（与打字机隔1行空白）
-    'staff_end':
-    TYPEWRITER_ROW_START + total_typewriter_lines + 1 + STAFF_TOTAL_LINES - 1,
+    'staff_end':  # 五线谱网格在标题行和中间边框之下
+    TYPEWRITER_ROW_START + total_typewriter_lines + 1 + 2 + STAFF_TOTAL_LINES - 1,
     'progress':
-    TYPEWRITER_ROW_START + total_typewriter_lines + 1 + STAFF_TOTAL_LINES,
+    TYPEWRITER_ROW_START + total_typewriter_lines + 1 + 2 + STAFF_TOTAL_LINES,
     'border_bottom':
-    TYPEWRITER_ROW_START + total_typewriter_lines + 1 + STAFF_TOTAL_LINES + 1
+    TYPEWRITER_ROW_START + total_typewriter_lines + 1 + 2 + STAFF_TOTAL_LINES + 1
 }
 
 
-# ===================== 修复核心：打字机线程（顶部固定+保留已打文字） =====================
-def typewriter_thread():
-    global is_typing_flag, typed_lines
+# ===================== 修复核心：打字机（顶部固定+保留已打文字） =====================
+def draw_typewriter_lines(lines, term_width):
+    # 重新打印所有已打行（固定在顶部，保留历史）
+    for i in range(len(lines)):
+        terminal_row = TYPEWRITER_ROW_START + i
+        # 移动光标到当前行开头
+        sys.stdout.write(f"\033[{terminal_row};1H")
+        # 清空当前行并打印已打文本（带颜色）
+        sys.stdout.write(
+            f"{TYPEWRITER_COLOR}{lines[i].ljust(term_width)}\033[0m")
+    sys.stdout.flush()
+
 
-    is_typing_flag = True
+async def typewriter_task(state):
     typed_lines = [""] * total_typewriter_lines  # 初始化空行列表（对应文本总行数）
+    state.set_typing(True, typed_lines)
     current_line_idx = 0  # 当前正在打印的行索引
     current_char_idx = 0  # 当前行的字符索引
     text_lines = TYPEWRITER_TEXT.split('\n')[1:]  # 分割文本为行（去掉开头空行）
@@ -246,43 +210,43 @@ def typewriter_thread():
     if len(text_lines) < total_typewriter_lines:
         text_lines += [""] * (total_typewriter_lines - len(text_lines))
 
-    while is_typing_flag and current_line_idx < total_typewriter_lines:
-        # 若音乐停止，停止打字
-        if not is_playing_flag:
-            break
-
-        current_line = text_lines[current_line_idx]
-        # 逐字符添加到当前行
-        if current_char_idx < len(current_line):
-            typed_char = current_line[current_char_idx]
-            typed_lines[current_line_idx] += typed_char
-            current_char_idx += 1
-        else:
-            # 当前行打完，切换到下一行
-            current_line_idx += 1
-            current_char_idx = 0
-
-        # 关键：重新打印所有已打行（固定在顶部，保留历史）
-        for i in range(len(typed_lines)):
-            terminal_row = TYPEWRITER_ROW_START + i
-            # 移动光标到当前行开头
-            sys.stdout.write(f"\033[{terminal_row};1H")
-            # 清空当前行并打印已打文本（带颜色）
-            sys.stdout.write(
-                f"{TYPEWRITER_COLOR}{typed_lines[i].ljust(term_width)}\033[0m")
-
-        sys.stdout.flush()
-        time.sleep(TYPEWRITER_SPEED)
-
-    # 打字完成后，补全未打完的行（避免残缺）
-    for i in range(current_line_idx, len(text_lines)):
-        terminal_row = TYPEWRITER_ROW_START + i
-        sys.stdout.write(f"\033[{terminal_row};1H")
-        sys.stdout.write(
-            f"{TYPEWRITER_COLOR}{text_lines[i].ljust(term_width)}\033[0m")
-    sys.stdout.flush()
-
-    is_typing_flag = False
+    # 每 TYPEWRITER_SPEED 秒打一步（一个字符或换一行），节拍取自播放时钟
+    step_samples = TYPEWRITER_SPEED * SAMPLE_RATE
+    step_count = 0
+    clock_jumped = state.clock_event()
+    try:
+        # 时钟结束（音乐播完/停止）后不再等待，直接补全
+        while (current_line_idx < total_typewriter_lines
+               and not state.clock.finished):
+            clock_jumped.clear()
+            # 补齐到当前播放位置应打的步数：终端慢时一次多打几个，不会越拖越晚
+            due_steps = int(state.clock.position() // step_samples) + 1
+            while (step_count < due_steps
+                   and current_line_idx < total_typewriter_lines):
+                current_line = text_lines[current_line_idx]
+                # 逐字符添加到当前行
+                if current_char_idx < len(current_line):
+                    typed_char = current_line[current_char_idx]
+                    typed_lines[current_line_idx] += typed_char
+                    current_char_idx += 1
+                else:
+                    # 当前行打完，切换到下一行
+                    current_line_idx += 1
+                    current_char_idx = 0
+                step_count += 1
+
+            state.set_typed_lines(typed_lines)
+            draw_typewriter_lines(typed_lines, state.term_width)
+            await sleep_until_sample(state.clock, step_count * step_samples,
+                                     clock_jumped)
+            if runtime_stats.enabled and not clock_jumped.is_set():
+                # 醒来时比这一步该打的时刻晚了多少（暂停/跳转后的那次不算）
+                late_samples = state.clock.position() - step_count * step_samples
+                runtime_stats.record('typewriter_lateness_ms',
+                                     max(late_samples, 0) / SAMPLE_RATE * 1e3)
+    finally:
+        # 打完或音乐停止：补全未打完的行（避免残缺），进度行随之刷新
+        state.set_typing(False, text_lines)
 
 
 # ===================== 快速打印代码（保留原功能） =====================
@@ -327,7 +291,15 @@ def clear_terminal():
 
 
 # ===================== 开始提示（适配打字机位置） =====================
-def show_start_prompt():
+def terminal_width():
+    # 自适应终端宽度（输出被重定向时按80列）
+    try:
+        return os.get_terminal_size().columns
+    except OSError:
+        return 80
+
+
+def show_start_prompt(term_width=80):
     clear_terminal()
 
     prompt_lines = [
@@ -352,233 +324,2788 @@ def show_start_prompt():
     time.sleep(2.5)  # 延长停留时间，让用户看清提示
 
 
+# ===================== 运行时统计（可选，--stats 开启；退出或收到 SIGUSR1 时写JSON） =====================
+STATS_MS_EDGES = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100,
+                  200, 500, 1000)  # 耗时类直方图的分桶上界（毫秒）
+STATS_CHARS_EDGES = (0, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+STATS_FLUSHES_EDGES = (0, 1, 2, 4, 8)
+
+
+class StatsHistogram:
+    # 固定分桶的直方图：只存各桶计数和总和，运行再久也不增长
+    def __init__(self, edges):
+        self.edges = edges
+        self.counts = [0] * (len(edges) + 1)  # 最后一桶放超过最大上界的
+        self.count = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.edges, value)] += 1
+        self.count += 1
+        self.total += value
+        self.total_squares += value * value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        # 按桶上界估算：返回累计计数首次达到 fraction 的那一桶的上界
+        target = fraction * self.count
+        cumulative = 0
+        for edge, bucket_count in zip(self.edges, self.counts):
+            cumulative += bucket_count
+            if cumulative >= target:
+                return min(edge, self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        mean = self.total / self.count
+        return {
+            'count': self.count,
+            'mean': mean,
+            'std': max(self.total_squares / self.count - mean * mean, 0)**0.5,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+            'histogram': [{'le': edge, 'count': bucket_count}
+                          for edge, bucket_count in zip(self.edges, self.counts)]
+            + [{'le': None, 'count': self.counts[-1]}],
+        }
+
+
+class CountingStream:
+    # 包住 sys.stdout，统计写出的字符数和 flush 次数
+    def __init__(self, stream):
+        self._stream = stream
+        self.chars = 0
+        self.flushes = 0
+
+    def write(self, text):
+        self.chars += len(text)
+        return self._stream.write(text)
+
+    def flush(self):
+        self.flushes += 1
+        self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class RuntimeStats:
+    # 播放期间的计时与计数：每个音符的合成耗时、五线谱每帧的耗时/间隔/字符数/flush数、
+    # 打字机每一步的迟到量。默认关闭，关闭时各记录点只多一次属性判断
+    def __init__(self):
+        self.enabled = False
+        self.output_path = None
+        self._lock = threading.RLock()
+        self._dump_lock = threading.Lock()  # 退出时和 SIGUSR1 触发的写文件不交错
+        self._dump_wakeup = None  # 信号处理函数 → 写文件线程的管道写端
+        self._histograms = {}
+        self._values = {}
+        self._stdout = None
+        self._started = None
+        self._last_frame_start = None
+
+    def enable(self, output_path):
+        # 开启统计：包住 stdout，退出时和收到 SIGUSR1 时写JSON
+        self.enabled = True
+        self.output_path = output_path
+        self._started = time.time()
+        self._stdout = sys.stdout = CountingStream(sys.stdout)
+        atexit.register(self.dump)
+        if hasattr(signal, 'SIGUSR1'):  # Windows 没有 SIGUSR1，只在退出时写
+            # 信号处理函数可能打断正持有锁的 record()，不能在里面直接写文件：
+            # 只往管道里写一个字节，由后台线程读到后再写JSON（连发的信号合并成一次）
+            wakeup_read, self._dump_wakeup = os.pipe()
+            os.set_blocking(self._dump_wakeup, False)
+            threading.Thread(target=self._dump_on_wakeup, args=(wakeup_read, ),
+                             name="stats-dump", daemon=True).start()
+            signal.signal(signal.SIGUSR1, self._on_dump_signal)
+
+    def _on_dump_signal(self, signum, frame):
+        try:
+            os.write(self._dump_wakeup, b"\0")
+        except BlockingIOError:
+            pass  # 管道已满，已经有一次写文件在排队
+
+    def _dump_on_wakeup(self, wakeup_read):
+        while os.read(wakeup_read, 512):
+            self.dump()
+
+    def record(self, name, value, edges=STATS_MS_EDGES):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = StatsHistogram(edges)
+            histogram.add(value)
+
+    def record_since(self, name, start):
+        # 记录从 start（perf_counter）到现在的毫秒数
+        if self.enabled:
+            self.record(name, (time.perf_counter() - start) * 1e3)
+
+    def set_value(self, name, value):
+        if self.enabled:
+            with self._lock:
+                self._values[name] = value
+
+    def begin_frame(self):
+        # 五线谱画一帧前调用，返回交给 end_frame；未开启时返回 None
+        if not self.enabled:
+            return None
+        return time.perf_counter(), self._stdout.chars, self._stdout.flushes
+
+    def end_frame(self, frame, lateness_ms, frame_bytes):
+        if frame is None:
+            return
+        frame_start, chars, flushes = frame
+        self.record_since('staff_frame_ms', frame_start)
+        if self._last_frame_start is not None:
+            self.record('staff_frame_interval_ms',
+                        (frame_start - self._last_frame_start) * 1e3)
+        self._last_frame_start = frame_start
+        self.record('staff_frame_lateness_ms', lateness_ms)
+        self.record('staff_frame_chars', self._stdout.chars - chars,
+                    STATS_CHARS_EDGES)
+        self.record('staff_frame_bytes', frame_bytes, STATS_CHARS_EDGES)
+        self.record('staff_frame_flushes', self._stdout.flushes - flushes,
+                    STATS_FLUSHES_EDGES)
+
+    def summary(self):
+        with self._lock:
+            histograms = {name: histogram.summary()
+                          for name, histogram in self._histograms.items()}
+            values = dict(self._values)
+        # 五线谱只在画面变化时才画，帧间隔反映的是乐谱节奏；抖动看每帧比预定时刻晚了多少
+        frame_lateness = histograms.get('staff_frame_lateness_ms', {})
+        return {
+            'started': time.strftime("%Y-%m-%dT%H:%M:%S",
+                                     time.localtime(self._started)),
+            'elapsed_seconds': time.time() - self._started,
+            'stdout': {'chars': self._stdout.chars,
+                       'flushes': self._stdout.flushes},
+            'staff_frame_jitter_ms': {'std': frame_lateness.get('std'),
+                                      'p95': frame_lateness.get('p95')},
+            'histograms': histograms,
+            **values,
+        }
+
+    def dump(self, output_path=None):
+        output_path = output_path or self.output_path
+        if not self.enabled or not output_path:
+            return
+        summary = self.summary()
+        with self._dump_lock:
+            with open(output_path, "w", encoding="utf-8") as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+runtime_stats = RuntimeStats()
+
+
 # ===================== 音频生成（原功能） =====================
-def generate_audio_note(freq, dur):
-    sample_count = int(SAMPLE_RATE * dur)
+def generate_audio_note(freq, dur, timbre=None):
+    oscillator = OSCILLATOR_ENGINES[SYNTH_ENGINE]
+    audio_wave = oscillator(freq, dur, timbre or SYNTH_TIMBRE)
+    if ENVELOPE_ADSR is not None and freq > 0:
+        # 原地相乘，消除音符首尾的咔哒声
+        np.multiply(audio_wave,
+                    get_envelope(len(audio_wave), ENVELOPE_ADSR),
+                    out=audio_wave,
+                    casting='unsafe')
+    return audio_wave
+
+
+# 逐采样正弦引擎：每个谐波都要在整条时间轴上算一次 np.sin
+def sine_audio_note(freq, dur, timbre=SYNTH_TIMBRE):
+    sample_count = int(round(SAMPLE_RATE * dur))
     time_axis = np.linspace(0, dur, sample_count, False)
 
     if freq > 0:
-        base_wave = 0.7 * np.sin(freq * time_axis * 2 * np.pi)
-        harmonic2 = 0.2 * np.sin(2 * freq * time_axis * 2 * np.pi)
-        harmonic3 = 0.1 * np.sin(3 * freq * time_axis * 2 * np.pi)
-        audio_wave = base_wave + harmonic2 + harmonic3
+        audio_wave = np.zeros(sample_count)
+        for harmonic, amplitude in TIMBRES[timbre]:
+            audio_wave += amplitude * np.sin(
+                harmonic * freq * time_axis * 2 * np.pi)
+        audio_wave *= 32767 / np.max(np.abs(audio_wave))
     else:
         audio_wave = np.zeros(sample_count)
 
-    audio_wave *= 32767 / np.max(np.abs(audio_wave))
     return audio_wave.astype(np.int16)
 
 
-# ===================== 播放线程（同步启动打字机） =====================
-def audio_play_thread():
-    global current_note_idx, is_playing_flag
-
-    # 预处理音频
-    total_audio = np.array([], dtype=np.int16)
-    note_durations = []
-    for note_code, dur_mult in music_notes:
-        note_freq = NOTE_FREQS[note_code]
-        actual_dur = dur_mult * QUARTER_NOTE_DURATION
-        note_audio = generate_audio_note(note_freq, actual_dur)
-        total_audio = np.append(total_audio, note_audio)
-        note_durations.append(actual_dur)
-
-    # 启动播放和打字机
-    is_playing_flag = True
-    play_obj = sa.play_buffer(total_audio, 1, 2, SAMPLE_RATE)
-    typing_thread = threading.Thread(target=typewriter_thread)
-    typing_thread.start()
-
-    # 同步更新当前音符索引
-    play_start_time = time.time()
-    while is_playing_flag:
-        elapsed_time = time.time() - play_start_time
-        accum_dur = 0
-        for idx, dur in enumerate(note_durations):
-            accum_dur += dur
-            if elapsed_time < accum_dur:
-                current_note_idx = idx
-                break
-        if elapsed_time >= sum(note_durations):
-            break
-        time.sleep(0.01)
+# ===================== 波表振荡器（每种音色一张单周期表） =====================
+wavetables = {}
+
+
+def build_wavetable(timbre):
+    table_size = 1 << WAVETABLE_BITS
+    cycle_axis = np.arange(table_size) / table_size
+    table = np.zeros(table_size)
+    for harmonic, amplitude in TIMBRES[timbre]:
+        # 带限：超过表长一半的谐波在表里无法表示，直接丢弃
+        if harmonic < table_size // 2:
+            table += amplitude * np.sin(harmonic * cycle_axis * 2 * np.pi)
+    # 幅度归一化提前到建表时完成，合成时不再逐采样归一化
+    table *= 32767 / np.max(np.abs(table))
+    # 多存一个点（首点），线性插值时 idx+1 不会越界
+    table = np.append(table, table[0]).astype(np.float32)
+    return table[:-1].copy(), np.diff(table).astype(np.float32)
+
+
+def get_wavetable(timbre):
+    if timbre not in wavetables:
+        wavetables[timbre] = build_wavetable(timbre)
+    return wavetables[timbre]
+
+
+def wavetable_audio_note(freq, dur, timbre=SYNTH_TIMBRE):
+    sample_count = int(round(SAMPLE_RATE * dur))
+    if freq <= 0:
+        return np.zeros(sample_count, dtype=np.int16)
+
+    table, table_slope = get_wavetable(timbre)
+    # 32位定点相位累加器：溢出即自然回绕一个周期
+    frac_bits = 32 - WAVETABLE_BITS
+    phase_step = np.uint32(round(freq / SAMPLE_RATE * (1 << 32)))
+    phase = np.arange(sample_count, dtype=np.uint32)
+    phase *= phase_step
+    table_idx = phase >> np.uint32(frac_bits)
+    phase &= np.uint32((1 << frac_bits) - 1)
+    frac = phase.astype(np.float32)
+    frac *= np.float32(1 / (1 << frac_bits))
+
+    # 线性插值：table[i] + frac * (table[i+1] - table[i])
+    audio_wave = table_slope[table_idx]
+    audio_wave *= frac
+    audio_wave += table[table_idx]
+    return audio_wave.astype(np.int16)
 
-    # 播放结束，停止打字机
-    play_obj.wait_done()
-    is_playing_flag = False
-    typing_thread.join()
 
+OSCILLATOR_ENGINES = {
+    'sine': sine_audio_note,
+    'wavetable': wavetable_audio_note,
+}
 
-# ===================== 五线谱可视化（关键：在打字机下方更新，不覆盖） =====================
-def staff_visual_thread():
-    global current_note_idx, is_playing_flag, term_width
 
-    # 自适应终端宽度
+# ===================== ADSR包络（按音符长度预计算并缓存） =====================
+envelopes = OrderedDict()  # 按采样数缓存的包络（LRU，条目数有上限）
+envelopes_lock = threading.Lock()
+
+
+def build_envelope(sample_count, adsr):
+    attack_sec, decay_sec, sustain, release_sec = adsr
+    attack = int(attack_sec * SAMPLE_RATE)
+    decay = int(decay_sec * SAMPLE_RATE)
+    release = int(release_sec * SAMPLE_RATE)
+    # 音符太短放不下完整包络时，起音/衰减/释音按比例压缩
+    segment_total = attack + decay + release
+    if segment_total > sample_count:
+        scale = sample_count / segment_total
+        attack, decay, release = (int(attack * scale), int(decay * scale),
+                                  int(release * scale))
+    key_points = [0, attack, attack + decay, sample_count - release,
+                  sample_count]
+    key_levels = [0.0, 1.0, sustain, sustain, 0.0]
+    envelope = np.interp(np.arange(sample_count), key_points,
+                         key_levels).astype(np.float32)
+    envelope.setflags(write=False)
+    return envelope
+
+
+def get_envelope(sample_count, adsr):
+    envelope_key = (sample_count, adsr)
+    with envelopes_lock:
+        envelope = envelopes.get(envelope_key)
+        if envelope is not None:
+            envelopes.move_to_end(envelope_key)
+            return envelope
+    envelope = build_envelope(sample_count, adsr)
+    with envelopes_lock:
+        envelopes[envelope_key] = envelope
+        # 变速乐谱/MIDI导入的音符长度五花八门，只留最近用过的几十种
+        while len(envelopes) > ENVELOPE_CACHE_MAX_ENTRIES:
+            envelopes.popitem(last=False)
+    return envelope
+
+
+# ===================== 音符波形缓存（按字节上限的LRU） =====================
+class NoteWaveCache:
+    # 以（频率，时长，引擎，音色，包络）为键缓存合成好的int16波形；返回的数组只读、可共享
+
+    def __init__(self, max_bytes=NOTE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._waves = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, freq, dur, timbre=None):
+        timbre = timbre or SYNTH_TIMBRE
+        cache_key = (freq, dur, SYNTH_ENGINE, timbre, ENVELOPE_ADSR)
+        with self._lock:
+            note_audio = self._waves.get(cache_key)
+            if note_audio is not None:
+                self._waves.move_to_end(cache_key)
+                self.hits += 1
+                return note_audio
+            self.misses += 1
+
+        # 合成放在锁外，避免阻塞其他线程的命中
+        synth_start = time.perf_counter()
+        note_audio = generate_audio_note(freq, dur, timbre)
+        runtime_stats.record_since('synth_note_ms', synth_start)
+        note_audio.setflags(write=False)
+        if note_audio.nbytes > self.max_bytes:
+            return note_audio  # 单个音符超过上限，不入缓存
+
+        with self._lock:
+            if cache_key not in self._waves:
+                self._waves[cache_key] = note_audio
+                self.current_bytes += note_audio.nbytes
+                while self.current_bytes > self.max_bytes:
+                    _, evicted_audio = self._waves.popitem(last=False)
+                    self.current_bytes -= evicted_audio.nbytes
+                    self.evictions += 1
+            return self._waves.get(cache_key, note_audio)
+
+    def clear(self):
+        with self._lock:
+            self._waves.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._waves),
+                'bytes': self.current_bytes,
+            }
+
+
+note_wave_cache = NoteWaveCache()
+
+
+def cached_audio_note(freq, dur, timbre=None):
+    return note_wave_cache.get(freq, dur, timbre)
+
+
+# ===================== 速度表：拍位置 → 秒 =====================
+TEMPO_MAP_DTYPE = np.dtype([('beat', np.float64), ('bpm', np.float64)])
+
+
+def make_tempo_map(tempo_changes=()):
+    # tempo_changes：[(拍位置, BPM), ...]；同一拍位置多次设置时以最后一次为准
+    changes = {0.0: DEFAULT_TEMPO_BPM}
+    for beat, bpm in tempo_changes:
+        changes[float(beat)] = float(bpm)
+    return np.array(sorted(changes.items()), dtype=TEMPO_MAP_DTYPE)
+
+
+DEFAULT_TEMPO_MAP = make_tempo_map()
+
+
+def beats_to_seconds(beats, tempo_map=DEFAULT_TEMPO_MAP):
+    # 速度变化点之间是匀速的：先算出每个变化点的绝对时间，再二分定位所在区间
+    seconds_per_beat = 60.0 / tempo_map['bpm']
+    change_seconds = np.concatenate(
+        ([0.0], np.cumsum(np.diff(tempo_map['beat']) * seconds_per_beat[:-1])))
+    segment = np.searchsorted(tempo_map['beat'], beats, side='right') - 1
+    return change_seconds[segment] + (
+        beats - tempo_map['beat'][segment]) * seconds_per_beat[segment]
+
+
+# ===================== 乐谱类型：numpy结构化数组（每行一个事件） =====================
+def score_dtype(chord_width=0):
+    fields = [
+        ('pitch', np.uint8),  # MIDI编号（和弦为第一个音）
+        ('duration', np.float32),  # 时值（拍数）
+        ('beat', np.float64),  # 起始拍位置
+        ('onset', np.float64),  # 起始时间（秒）
+        ('offset', np.int64),  # 起始采样偏移
+        ('end_offset', np.int64),  # 结束采样偏移（= 下一个事件的起点）
+    ]
+    if chord_width:
+        fields.append(('chord', np.uint8, (chord_width, )))  # 和弦其余音，0=空
+    return np.dtype(fields)
+
+
+class Score:
+    # 一条音轨。onset/offset 在构建时按速度表一次算好；切片得到共享数据的视图，
+    # 视图里的 onset/offset 仍是相对整首曲子的绝对位置
+
+    def __init__(self, events, tempo_map=DEFAULT_TEMPO_MAP):
+        self.events = events
+        self.tempo_map = tempo_map
+
+    @classmethod
+    def from_arrays(cls, pitches, durations, chords=None,
+                    tempo_map=DEFAULT_TEMPO_MAP):
+        durations = np.asarray(durations, dtype=np.float64)
+        chord_width = 0 if chords is None else chords.shape[1]
+        events = np.zeros(len(durations), dtype=score_dtype(chord_width))
+        events['pitch'] = pitches
+        events['duration'] = durations
+        if chord_width:
+            events['chord'] = chords
+
+        # 起点由累计拍位置直接换算并取整到采样，逐音符取整的误差不会累积；
+        # 累加用 float64 原值（float32 的 1/3 连加几十万次会偏出几十个采样）
+        beats = np.zeros(len(durations) + 1)
+        np.cumsum(durations, out=beats[1:])
+        seconds = beats_to_seconds(beats, tempo_map)
+        offsets = np.rint(seconds * SAMPLE_RATE).astype(np.int64)
+        events['beat'] = beats[:-1]
+        events['onset'] = seconds[:-1]
+        events['offset'] = offsets[:-1]
+        events['end_offset'] = offsets[1:]
+        return cls(events, tempo_map)
+
+    # ---------- 向量化访问 ----------
+    @property
+    def pitches(self):
+        return self.events['pitch']
+
+    @property
+    def durations(self):
+        return self.events['duration']
+
+    @property
+    def beats(self):
+        return self.events['beat']
+
+    @property
+    def onsets(self):
+        return self.events['onset']
+
+    @property
+    def offsets(self):
+        return self.events['offset']
+
+    @property
+    def seconds(self):
+        # 实际时长取采样数换算，合成的波形长度与所占的采样区间严格一致
+        return self.sample_counts / SAMPLE_RATE
+
+    @property
+    def sample_counts(self):
+        return self.end_offsets - self.offsets
+
+    @property
+    def end_offsets(self):
+        return self.events['end_offset']
+
+    @property
+    def end_sample(self):
+        return int(self.end_offsets[-1]) if len(self) else 0
+
+    @property
+    def voice_count(self):
+        # 最大同时发声数：1 + 和弦中其余音的最大个数
+        if 'chord' not in self.events.dtype.names or not len(self):
+            return 1
+        return 1 + int(np.count_nonzero(self.events['chord'], axis=1).max())
+
+    def note_pitches(self, idx):
+        event = self.events[idx]
+        if 'chord' not in self.events.dtype.names:
+            return (int(event['pitch']), )
+        return (int(event['pitch']), ) + tuple(
+            int(pitch) for pitch in event['chord'] if pitch)
+
+    def pitch_tuples(self):
+        # 逐音符遍历时先转成Python列表，避免反复创建numpy标量
+        if 'chord' not in self.events.dtype.names:
+            return [(pitch, ) for pitch in self.pitches.tolist()]
+        return [
+            (pitch, ) + tuple(extra for extra in chord if extra)
+            for pitch, chord in zip(self.pitches.tolist(),
+                                    self.events['chord'].tolist())
+        ]
+
+    # ---------- 兼容 (音符, 时值) 元组列表的用法 ----------
+    def __len__(self):
+        return len(self.events)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return Score(self.events[idx], self.tempo_map)
+        pitches = self.note_pitches(idx)
+        note = pitches[0] if len(pitches) == 1 else pitches
+        return note, float(self.events['duration'][idx])
+
+    def __iter__(self):
+        for pitches, dur in zip(self.pitch_tuples(), self.durations.tolist()):
+            yield (pitches[0] if len(pitches) == 1 else pitches), dur
+
+
+# ===================== 多音轨：和弦与声部 =====================
+def mix_gain(tracks):
+    # 余量按最大同时发声数预留：各音轨最大和弦音数之和（单声部=1，不衰减）
+    voice_count = sum(score.voice_count for score in tracks if len(score))
+    return 1.0 / max(1, voice_count)
+
+
+def score_note_lists(score):
+    # 合成循环里用到的逐音符数据：起止采样、音高元组、实际时长（秒）
+    return (score.offsets.tolist(), score.end_offsets.tolist(),
+            score.pitch_tuples(), score.seconds.tolist())
+
+
+# ===================== 整曲合成（预分配缓冲区，按切片写入） =====================
+def render_score(tracks):
+    total_samples = max((score.end_sample for score in tracks), default=0)
+    mix = np.zeros(total_samples, dtype=np.float32)
+
+    for score in tracks:
+        starts, ends, pitch_tuples, note_seconds = score_note_lists(score)
+        # 相同（音高，时长）只合成一次，再批量叠加到各自的切片
+        note_batches = {}
+        for idx, batch_key in enumerate(zip(pitch_tuples, note_seconds)):
+            note_batches.setdefault(batch_key, []).append(idx)
+
+        for (pitches, actual_dur), note_indices in note_batches.items():
+            for pitch in pitches:
+                note_freq = PITCH_FREQS[pitch]
+                if note_freq <= 0:
+                    continue  # 休止符：缓冲区本身就是静音
+                note_audio = cached_audio_note(note_freq, actual_dur)
+                for idx in note_indices:
+                    mix[starts[idx]:ends[idx]] += note_audio
+
+    # 余量只在最后统一施加一次
+    mix *= mix_gain(tracks)
+    return mix.astype(np.int16), [score.offsets for score in tracks]
+
+
+# ===================== 流式合成：按固定大小逐块产出PCM =====================
+def mix_window(track_lists, note_cursors, win_start, win_end):
+    # 叠加 [win_start, win_end) 内的所有音符；note_cursors 记录每条音轨的进度
+    mix = np.zeros(win_end - win_start, dtype=np.float32)
+    for track_idx, (starts, ends, pitch_tuples,
+                    note_seconds) in enumerate(track_lists):
+        idx = note_cursors[track_idx]
+        while idx < len(starts) and starts[idx] < win_end:
+            note_start, note_end = starts[idx], ends[idx]
+            lo, hi = max(note_start, win_start), min(note_end, win_end)
+            for pitch in pitch_tuples[idx]:
+                note_freq = PITCH_FREQS[pitch]
+                if note_freq <= 0 or hi <= lo:
+                    continue  # 休止符不合成：新块本身就是静音
+                note_audio = cached_audio_note(note_freq, note_seconds[idx])
+                mix[lo - win_start:hi - win_start] += \
+                    note_audio[lo - note_start:hi - note_start]
+            if note_end > win_end:
+                break  # 音符延续到下一块
+            idx += 1
+        note_cursors[track_idx] = idx
+    return mix
+
+
+def iter_score_chunks(tracks, chunk_samples=STREAM_CHUNK_SAMPLES):
+    track_lists = [score_note_lists(score) for score in tracks]
+    total_samples = max((score.end_sample for score in tracks), default=0)
+    gain = mix_gain(tracks)
+    note_cursors = [0] * len(tracks)
+
+    for chunk_start in range(0, total_samples, chunk_samples):
+        chunk_end = min(chunk_start + chunk_samples, total_samples)
+        # 每条音轨记住上次的位置，只处理与当前块重叠的音符
+        mix = mix_window(track_lists, note_cursors, chunk_start, chunk_end)
+        mix *= gain
+        yield mix.astype(np.int16)
+
+
+def note_cursors_at(tracks, sample):
+    # 二分定位每条音轨中覆盖 sample 的音符（从曲中任意位置开始合成时用）
+    return [
+        max(0, int(np.searchsorted(score.offsets, sample, 'right')) - 1)
+        for score in tracks
+    ]
+
+
+# ===================== 多进程并行合成（写入同一块共享内存） =====================
+def current_synth_settings():
+    return (SYNTH_ENGINE, SYNTH_TIMBRE, ENVELOPE_ADSR)
+
+
+def apply_synth_settings(synth_settings):
+    global SYNTH_ENGINE, SYNTH_TIMBRE, ENVELOPE_ADSR
+    # spawn 方式启动的子进程只有默认配置，需要同步父进程的合成设置
+    SYNTH_ENGINE, SYNTH_TIMBRE, ENVELOPE_ADSR = synth_settings
+
+
+def render_range_worker(shm_name, total_samples, tracks, range_start,
+                        range_end, synth_settings):
+    apply_synth_settings(synth_settings)
+
+    shm = shared_memory.SharedMemory(name=shm_name)
     try:
-        term_width = os.get_terminal_size().columns
-    except OSError:
-        term_width = 80
-
-    # 初始化五线谱固定框架（在打字机下方）
-    def init_staff_frame():
-        # 打印五线谱顶部边框（与打字机隔1行）
-        border_row = fixed_lines['staff_start'] - 1
-        sys.stdout.write(f"\033[{border_row};1H")
-        sys.stdout.write("=" * term_width)
-
-        # 打印五线谱标题
-        title_row = fixed_lines['staff_start']
-        sys.stdout.write(f"\033[{title_row};1H")
-        sys.stdout.write(
-            "🎵 五线谱播放区 | 当前播放：\033[31m红色音符\033[0m | 按Ctrl+C停止".center(
-                term_width))
-
-        # 打印五线谱中间边框
-        mid_border_row = fixed_lines['staff_start'] + 1
-        sys.stdout.write(f"\033[{mid_border_row};1H")
-        sys.stdout.write("-" * term_width)
-
-        # 初始化五线谱空白框架
-        for i in range(STAFF_TOTAL_LINES):
-            staff_row = fixed_lines['staff_start'] + 2 + i
-            sys.stdout.write(f"\033[{staff_row};1H")
-            if i in STAFF_LINE_ROWS:
-                sys.stdout.write(STAFF_LINE_CHAR * term_width)
+        shared_audio = np.ndarray((total_samples, ),
+                                  dtype=np.int16,
+                                  buffer=shm.buf)
+        track_lists = [score_note_lists(score) for score in tracks]
+        note_cursors = note_cursors_at(tracks, range_start)
+        gain = mix_gain(tracks)
+        for win_start in range(range_start, range_end, STREAM_CHUNK_SAMPLES):
+            win_end = min(win_start + STREAM_CHUNK_SAMPLES, range_end)
+            mix = mix_window(track_lists, note_cursors, win_start, win_end)
+            mix *= gain
+            shared_audio[win_start:win_end] = mix.astype(np.int16)
+        del shared_audio  # 释放对共享内存的引用，否则无法 close
+    finally:
+        shm.close()
+
+
+def render_score_parallel(tracks, workers=PARALLEL_WORKERS):
+    workers = os.cpu_count() if workers is None else workers
+    total_samples = max((score.end_sample for score in tracks), default=0)
+    if workers <= 1 or total_samples < PARALLEL_MIN_SAMPLES:
+        return render_score(tracks)
+
+    # 按采样偏移把整曲均分为若干区间，每个进程直接写自己的那一段
+    range_bounds = np.linspace(0, total_samples, workers + 1).astype(int)
+    synth_settings = current_synth_settings()
+    shm = shared_memory.SharedMemory(create=True, size=total_samples * 2)
+    try:
+        jobs = [(shm.name, total_samples, tracks, int(range_start),
+                 int(range_end), synth_settings)
+                for range_start, range_end in zip(range_bounds[:-1],
+                                                  range_bounds[1:])
+                if range_end > range_start]
+        with multiprocessing.Pool(len(jobs)) as pool:
+            pool.starmap(render_range_worker, jobs)
+
+        shared_audio = np.ndarray((total_samples, ),
+                                  dtype=np.int16,
+                                  buffer=shm.buf)
+        total_audio = shared_audio.copy()
+        del shared_audio
+    finally:
+        shm.close()
+        shm.unlink()
+    return total_audio, [score.offsets for score in tracks]
+
+
+# ===================== 音频输出后端（声卡 / 无声 / WAV文件） =====================
+class NullAudioBackend:
+    # 输出后端接口：play 送入一段 int16 单声道PCM后立即返回，position 为这段已播出的
+    # 采样数，wait_done 阻塞到这段播完，stop 打断这段，close 释放设备/文件。一次只播一段。
+    # 本类不接声卡，按实时速率"播放"（无声卡的机器上也能跑完整播放器和画面），
+    # 也是其他后端的基类：位置按从开始出声起经过的墙钟时间估算
+    name = "null"
+
+    def __init__(self):
+        self._segment_samples = 0
+        self._segment_start = None
+        self._stopped = threading.Event()
+
+    def play(self, samples):
+        self._segment_samples = len(samples)
+        self._segment_start = time.perf_counter()
+        self._stopped.clear()
+
+    def position(self):
+        if self._segment_start is None:
+            return 0
+        elapsed = int((time.perf_counter() - self._segment_start) * SAMPLE_RATE)
+        return min(elapsed, self._segment_samples)
+
+    def wait_done(self):
+        remaining = self._segment_samples - self.position()
+        self._stopped.wait(max(remaining, 0) / SAMPLE_RATE)
+
+    def stop(self):
+        # 位置停在打断处
+        self._segment_samples = self.position()
+        self._stopped.set()
+
+    def close(self):
+        self.stop()
+
+
+class SimpleaudioBackend(NullAudioBackend):
+    # simpleaudio 不提供播放位置查询，位置沿用基类的墙钟估算
+    name = "simpleaudio"
+
+    def __init__(self):
+        if sa is None:
+            raise ImportError("未安装 simpleaudio，无法实时播放")
+        super().__init__()
+        self._play_obj = None
+
+    def play(self, samples):
+        self._play_obj = sa.play_buffer(samples, 1, 2, SAMPLE_RATE)
+        super().play(samples)
+
+    def wait_done(self):
+        self._play_obj.wait_done()
+
+    def stop(self):
+        super().stop()
+        if self._play_obj is not None:
+            self._play_obj.stop()
+
+
+class WavFileBackend(NullAudioBackend):
+    # 把实际"播出"的采样写进WAV（暂停/跳转打断的块只写到打断处）。
+    # realtime=False 时不等待，整段立即算作播完，用于尽快跑完整个播放流程
+    name = "wav"
+
+    def __init__(self, wav_path, realtime=True):
+        super().__init__()
+        self._realtime = realtime
+        self._samples = None
+        self._wav = wave.open(wav_path, "wb")
+        self._wav.setnchannels(1)
+        self._wav.setsampwidth(2)
+        self._wav.setframerate(SAMPLE_RATE)
+        self.samples_written = 0
+
+    def play(self, samples):
+        super().play(samples)
+        self._samples = samples
+
+    def position(self):
+        if not self._realtime:
+            return self._segment_samples
+        return super().position()
+
+    def wait_done(self):
+        if self._realtime:
+            super().wait_done()
+        if self._samples is not None:
+            played = self._samples[:self.position()]
+            self._wav.writeframes(np.ascontiguousarray(played).tobytes())
+            self.samples_written += len(played)
+            self._samples = None
+
+    def close(self):
+        super().close()
+        self._wav.close()
+
+
+AUDIO_BACKENDS = ('simpleaudio', 'null', 'wav')
+
+
+def make_audio_backend(name, wav_path=None):
+    if name == 'simpleaudio':
+        return SimpleaudioBackend()
+    if name == 'null':
+        return NullAudioBackend()
+    if name == 'wav':
+        return WavFileBackend(wav_path or DEFAULT_PLAYBACK_WAV_PATH)
+    raise ValueError(f"未知的音频后端：{name}（可选 {'、'.join(AUDIO_BACKENDS)}）")
+
+
+# ===================== 播放时钟（按后端已播放的采样数计时） =====================
+class PlaybackClock:
+    # 以"某段缓冲区开始出声/播完"为锚点：
+    # 位置 = 当前段的起始采样 + 后端报告的这段已播出采样（不超过该段长度）。
+    # 每段播完都重新对齐，段与段之间的空隙里时钟停住，不会跑到声音前面。
+    # 位置是曲中的采样位置：暂停/跳转时由播放器直接改写
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = threading.Event()
+        self._base_sample = 0
+        self._segment_samples = 0
+        self._segment_backend = None  # 正在播当前段的后端，段间为None
+        self._listeners = []
+        self.paused = False
+        self.finished = False
+
+    def subscribe(self, callback):
+        # 暂停/继续/跳转/结束时回调（在调用这些方法的线程里执行）
+        self._listeners.append(callback)
+
+    def _notify(self):
+        for callback in self._listeners:
+            callback()
+
+    def begin_segment(self, start_sample, sample_count, backend):
+        with self._lock:
+            self._base_sample = start_sample
+            self._segment_samples = sample_count
+            self._segment_backend = backend
+        self._started.set()
+
+    def end_segment(self):
+        with self._lock:
+            if self._segment_backend is not None:
+                self._base_sample += self._segment_samples
+            self._segment_samples = 0
+            self._segment_backend = None
+
+    def jump(self, sample, paused=False):
+        with self._lock:
+            self._base_sample = sample
+            self._segment_samples = 0
+            self._segment_backend = None
+            self.paused = paused
+        self._notify()
+
+    def finish(self):
+        self.end_segment()
+        self.finished = True
+        self._started.set()
+        self._notify()
+
+    def wait_started(self, timeout=None):
+        return self._started.wait(timeout)
+
+    def position(self):
+        with self._lock:
+            if self._segment_backend is None:
+                return self._base_sample
+            return self._base_sample + min(self._segment_backend.position(),
+                                           self._segment_samples)
+
+
+# ===================== 可跳转的整曲PCM（按块合成，记录哪些块已就绪） =====================
+class ScoreTimeline:
+    # 每块是否已合成的标记 + 已合成的PCM。按需逐块合成，跳转后从目标块继续；
+    # 已合成的块直接复用，回跳、暂停后继续都不再重新合成。
+    # 写缓存时PCM在整曲长度的内存映射文件里（由系统换页，不占常驻内存）；
+    # 不写缓存时只在内存里留最近合成的 keep_chunks 块，内存不随曲长增长
+    def __init__(self, tracks, chunk_samples=STREAM_CHUNK_SAMPLES, pcm=None,
+                 cache_path=None, keep_chunks=STREAM_KEEP_CHUNKS):
+        self.tracks = tracks
+        self.chunk_samples = chunk_samples
+        self.total_samples = len(pcm) if pcm is not None else max(
+            (score.end_sample for score in tracks), default=0)
+        self.chunk_count = -(-self.total_samples // chunk_samples)
+        self.keep_chunks = keep_chunks
+        self._cache_path = None
+        self._cache_tmp_path = None
+        self._chunks = None  # 不写缓存时：块序号 -> 已合成的块（LRU）
+        if pcm is not None:
+            # 命中磁盘缓存：整曲已就绪（内存映射）
+            self.pcm = pcm
+            self.ready = np.ones(self.chunk_count, dtype=bool)
+        elif cache_path and self._open_cache_file(cache_path):
+            # 边合成边写进缓存文件；全部块合成完才改名落盘，否则关闭时丢弃
+            self.ready = np.zeros(self.chunk_count, dtype=bool)
+        else:
+            self.pcm = None
+            self._chunks = OrderedDict()
+            self.ready = np.zeros(self.chunk_count, dtype=bool)
+        self._closed = False
+        self._lock = threading.Lock()  # 合成与关闭互斥（播放列表里由不同线程收尾）
+        self._track_lists = None
+        self._note_cursors = None
+        self._cursor_chunk = None  # 音符游标当前停在哪一块的开头
+
+    def _open_cache_file(self, cache_path):
+        # 缓存文件建不了（磁盘满、目录只读）时返回 False，退回纯内存合成。
+        # 临时文件每个时间轴一个：播放列表里同一首歌可能同时有两个时间轴在合成
+        try:
+            fd, tmp_path = tempfile.mkstemp(suffix=".tmp",
+                                            prefix=os.path.basename(cache_path) + ".",
+                                            dir=os.path.dirname(cache_path))
+        except OSError:
+            return False
+        os.close(fd)
+        try:
+            self.pcm = np.lib.format.open_memmap(tmp_path,
+                                                 mode='w+',
+                                                 dtype=np.int16,
+                                                 shape=(self.total_samples, ))
+        except OSError:
+            os.remove(tmp_path)
+            return False
+        self._cache_path = cache_path
+        self._cache_tmp_path = tmp_path
+        return True
+
+    def chunk_bounds(self, chunk_idx):
+        chunk_start = chunk_idx * self.chunk_samples
+        return chunk_start, min(chunk_start + self.chunk_samples,
+                                self.total_samples)
+
+    def missing_chunk(self, first_chunk, count):
+        # [first_chunk, first_chunk + count) 里第一个还没合成的块，没有则 None
+        window = self.ready[first_chunk:first_chunk + count]
+        missing = np.flatnonzero(~window)
+        return first_chunk + int(missing[0]) if len(missing) else None
+
+    @property
+    def prefetch_chunks(self):
+        # 空闲时提前合成的块数：只留最近几块时，多合成的会被挤掉
+        if self._chunks is None:
+            return self.chunk_count
+        return min(self.chunk_count, self.keep_chunks)
+
+    def samples(self, start, end):
+        # [start, end) 须落在同一个已合成的块里
+        if self._chunks is None:
+            return self.pcm[start:end]
+        chunk_idx = start // self.chunk_samples
+        chunk_start = chunk_idx * self.chunk_samples
+        return self._chunks[chunk_idx][start - chunk_start:end - chunk_start]
+
+    def render_chunk(self, chunk_idx):
+        with self._lock:
+            if not self._closed:
+                render_start = time.perf_counter()
+                self._render_chunk(chunk_idx)
+                runtime_stats.record_since('synth_chunk_ms', render_start)
+
+    def _render_chunk(self, chunk_idx):
+        if self._track_lists is None:
+            self._track_lists = [score_note_lists(score) for score in self.tracks]
+            self._gain = mix_gain(self.tracks)
+        chunk_start, chunk_end = self.chunk_bounds(chunk_idx)
+        if chunk_idx != self._cursor_chunk:
+            # 跳转过：按起始采样二分重新定位各音轨的音符游标
+            self._note_cursors = note_cursors_at(self.tracks, chunk_start)
+        mix = mix_window(self._track_lists, self._note_cursors, chunk_start,
+                         chunk_end)
+        mix *= self._gain
+        if self._chunks is None:
+            self.pcm[chunk_start:chunk_end] = mix.astype(np.int16)
+        else:
+            self._chunks[chunk_idx] = mix.astype(np.int16)
+            while len(self._chunks) > self.keep_chunks:
+                evicted_idx, _ = self._chunks.popitem(last=False)
+                self.ready[evicted_idx] = False
+        self._cursor_chunk = chunk_idx + 1
+        self.ready[chunk_idx] = True
+
+    def render_all(self):
+        # 开播前一次合成整曲（可拆给多个进程）
+        total_audio, _ = render_score_parallel(self.tracks)
+        with self._lock:
+            if self._closed:
+                return
+            if self._chunks is None:
+                self.pcm[:] = total_audio
             else:
-                sys.stdout.write(" " * term_width)
+                self.pcm, self._chunks = total_audio, None  # 整曲模式本来就占整曲内存
+            self.ready[:] = True
+
+    def close(self):
+        # 释放PCM；完整合成过的写进缓存
+        with self._lock:
+            self._closed = True
+            self._chunks = None
+            if self._cache_tmp_path is None:
+                self.pcm = None
+                return
+            try:
+                # 同一首歌的另一个时间轴已经落盘过就不再覆盖（可能正被映射着播放）
+                if self.ready.all() and not os.path.exists(self._cache_path):
+                    self.pcm.flush()
+                    self.pcm = None  # Windows 下需先释放映射才能改名
+                    os.replace(self._cache_tmp_path, self._cache_path)
+            except OSError:
+                pass  # 写缓存失败只是下次还要重新合成
+            finally:
+                self.pcm = None
+                try:
+                    os.remove(self._cache_tmp_path)
+                except OSError:
+                    pass  # 已改名落盘，或本来就没建成
+                self._cache_tmp_path = None
+
+
+# ===================== 环形缓冲区（合成线程 → 送声线程，单生产者/单消费者） =====================
+class SampleRingBuffer:
+    # 预先分配的 int16 环形缓冲区，容量即合成与输出之间的延迟。
+    # 只有一个写者（合成线程）和一个读者（送声线程）：写者只改 _write_pos，
+    # 读者只改 _read_pos，两者只增不减、取模得下标，读写数据都不加锁。
+    # 缓冲区空/满时的等待由调用方自己的条件变量负责
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        self._samples = np.zeros(self.capacity, dtype=np.int16)
+        self._write_pos = 0
+        self._read_pos = 0
+        self.low_water = self.capacity  # 读者取下一块时缓冲区里最少剩过多少采样（读者维护）
+        self.underruns = 0  # 读者要取数据时缓冲区不够的次数（读者维护）
+
+    @property
+    def write_pos(self):
+        return self._write_pos
+
+    def fill(self):
+        return self._write_pos - self._read_pos
+
+    def free(self):
+        return self.capacity - self.fill()
+
+    def write(self, samples):
+        # 写者：尽量写入，返回实际写入的采样数（缓冲区满时少写）
+        count = min(len(samples), self.free())
+        start = self._write_pos % self.capacity
+        first = min(count, self.capacity - start)
+        self._samples[start:start + first] = samples[:first]
+        self._samples[:count - first] = samples[first:count]
+        self._write_pos += count  # 数据写好后才移动写位置，读者不会读到半截
+        return count
+
+    def read_into(self, out):
+        # 读者：读出 len(out) 个采样（调用方保证 fill() 足够）
+        count = len(out)
+        start = self._read_pos % self.capacity
+        first = min(count, self.capacity - start)
+        out[:first] = self._samples[start:start + first]
+        out[first:] = self._samples[:count - first]
+        self._read_pos += count
+
+    def note_reader_fill(self, wanted):
+        # 读者：上一块播完、要取下一块时记一次余量；不够 wanted 就是一次下溢
+        fill = self.fill()
+        self.low_water = min(self.low_water, fill)
+        if fill < wanted:
+            self.underruns += 1
+
+    def skip_to(self, position):
+        # 读者：丢掉 position 之前的数据（暂停/跳转后写者从新位置重写）
+        self._read_pos = position
+
+    def metrics(self):
+        return {
+            'capacity_samples': self.capacity,
+            'latency_seconds': self.capacity / SAMPLE_RATE,
+            'low_water_samples': self.low_water,
+            'low_water_seconds': self.low_water / SAMPLE_RATE,
+            'underruns': self.underruns,
+        }
+
+
+# ===================== 流式播放器（合成线程 + 送声线程，可暂停/跳转） =====================
+class StreamPlayer:
+    # 接口与 simpleaudio 的 PlayObject 保持一致（wait_done / stop），另有暂停/跳转。
+    # 合成线程按播放顺序把PCM写进环形缓冲区（需要时先合成那一块，合成结果留在整曲
+    # 缓冲区里供跳转和缓存复用）；送声线程从环形缓冲区取一块送进输出后端。
+    # 环形缓冲区写满时合成线程停下，送声线程取不到数据记一次下溢。
+    # 后端一次只播一段，只能把块首尾相接地依次送入；暂停/跳转就是打断当前块，
+    # 合成线程从新的播放位置重写缓冲区，已合成的PCM不会重新合成。
+    # 播放列表：queue_next 排好下一首后，合成线程空闲时就开始合成它，
+    # 写完当前曲目紧接着写下一首，送声与曲内换块一样没有额外停顿
+
+    def __init__(self, timeline, latency=STREAM_LATENCY_SECONDS, clock=None,
+                 backend=None, render_first=False):
+        # latency：环形缓冲区容量（秒，至少一块）；render_first：开播前先合成整曲；
+        # backend 默认为声卡，随播放器一起关闭
+        self._timeline = timeline
+        self._render_first = render_first
+        self._clock = clock or PlaybackClock()
+        self._backend = backend or SimpleaudioBackend()
+        self._ring = SampleRingBuffer(
+            max(int(latency * SAMPLE_RATE), timeline.chunk_samples))
+        self._segment = np.empty(timeline.chunk_samples, dtype=np.int16)
+        self._cond = threading.Condition()
+        self._cursor = 0  # 下一个要送进后端的采样
+        self._jumps = 0  # 暂停/跳转次数：据此判断当前块是否被打断、缓冲区是否作废
+        self._paused = False
+        self._stopped = False
+        self._next = None  # 播放列表的下一首：(ScoreTimeline, PlaybackClock)
+        self._more_songs = False  # 当前曲目之后还有歌，播完时要等它排进来
+        # 合成线程写入的各段：(缓冲区起点, 曲目, 时钟, 曲中起始采样, 跳转次数)。
+        # 第一段是正在播的，第二段（若有）是写在它后面的下一首
+        self._runs = []
+        self._run = None  # 送声线程正在读的那段
+        self._write_jumps = None  # 合成线程按哪一次跳转后的位置在写
+        self._write_cursor = 0  # 合成线程下一个要写入的曲中采样
+        self._first_sound = threading.Event()
+        self._producer = threading.Thread(target=self._produce, daemon=True)
+        self._feeder = threading.Thread(target=self._feed, daemon=True)
+
+    def start(self):
+        self._producer.start()
+        self._feeder.start()
+        self._first_sound.wait()  # 第一块开始出声后再返回，便于对齐计时
+        return self
+
+    def _start_run(self, timeline, clock, start_sample):
+        # 调用方已持有锁：从 start_sample 起在缓冲区当前写位置写一段新的
+        self._runs.append((self._ring.write_pos, timeline, clock, start_sample,
+                           self._jumps))
+        self._write_cursor = start_sample
+        self._cond.notify_all()
+
+    def _next_job(self):
+        # 调用方已持有锁：返回合成线程接下来要做的事，没有则返回 None
+        if self._write_jumps != self._jumps:
+            # 暂停/跳转后缓冲区里的数据作废，从新的播放位置重写
+            self._write_jumps = self._jumps
+            self._runs.clear()
+            self._start_run(self._timeline, self._clock, self._cursor)
+        _, timeline, _, _, _ = self._runs[-1]
+        if (self._write_cursor >= timeline.total_samples
+                and len(self._runs) == 1 and self._next is not None):
+            # 当前曲目写完：紧接着写下一首
+            self._start_run(*self._next, 0)
+            timeline = self._next[0]
+        if self._write_cursor < timeline.total_samples:
+            chunk_idx = self._write_cursor // timeline.chunk_samples
+            if not timeline.ready[chunk_idx]:
+                return 'render', timeline, chunk_idx
+            if self._ring.free() > 0:
+                return 'write', timeline, chunk_idx
+        if self._next is not None:
+            # 缓冲区已满：空闲时合成下一首
+            timeline = self._next[0]
+            chunk_idx = timeline.missing_chunk(0, timeline.prefetch_chunks)
+            if chunk_idx is not None:
+                return 'render', timeline, chunk_idx
+        return None
+
+    def _produce(self):
+        if self._render_first:
+            self._timeline.render_all()
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    job = self._next_job()
+                    if job is not None:
+                        break
+                    self._cond.wait()  # 缓冲区满且无事可做：等送声线程取走数据
+                action, timeline, chunk_idx = job
+                write_start, jumps = self._write_cursor, self._jumps
+            if action == 'render':
+                timeline.render_chunk(chunk_idx)
+                written = 0
+            else:
+                _, chunk_end = timeline.chunk_bounds(chunk_idx)
+                written = self._ring.write(
+                    timeline.samples(write_start, chunk_end))
+            with self._cond:
+                if self._jumps == jumps:  # 写入期间被暂停/跳转的数据作废
+                    self._write_cursor += written
+                self._cond.notify_all()
+
+    def _segment_wanted(self):
+        return min(self._timeline.chunk_samples,
+                   self._timeline.total_samples - self._cursor)
+
+    def _draining_last_song(self):
+        # 最后一首的剩余部分已全部写进缓冲区：水位下降是曲子快完了，不是合成跟不上
+        return (len(self._runs) == 1 and self._next is None
+                and not self._more_songs and self._ring.fill() >=
+                self._timeline.total_samples - self._cursor)
+
+    def _adopt_run(self):
+        # 调用方已持有锁：改读合成线程最新写的那段，跳过缓冲区里作废的数据
+        if self._runs[0] is not self._run:
+            self._run = self._runs[0]
+            self._ring.skip_to(self._run[0])
+            self._cond.notify_all()  # 腾出了空间，合成线程继续写
+
+    def _waiting_to_feed(self):
+        if self._paused:
+            return True
+        if not self._runs or self._runs[0][4] != self._jumps:
+            return True  # 合成线程还没从新位置开始写
+        self._adopt_run()
+        if self._cursor >= self._timeline.total_samples:
+            # 本曲已送完：等下一首写进来，没有下一首就结束
+            return (len(self._runs) == 1
+                    and (self._next is not None or self._more_songs))
+        return self._ring.fill() < self._segment_wanted()
+
+    def _feed(self):
+        try:
+            while True:
+                with self._cond:
+                    if (self._run is not None and not self._paused
+                            and self._runs and self._runs[0] is self._run
+                            and self._cursor < self._timeline.total_samples
+                            and not self._draining_last_song()):
+                        # 稳态播放中（不是刚开始/刚跳转/刚换歌）才计入水位和下溢
+                        self._ring.note_reader_fill(self._segment_wanted())
+                    while not self._stopped and self._waiting_to_feed():
+                        self._cond.wait()
+                    if self._stopped:
+                        break
+                    if self._cursor >= self._timeline.total_samples:
+                        if len(self._runs) == 1:
+                            break
+                        # 无缝换歌：结束上一首的时钟，从下一首的第0个采样继续
+                        self._runs.pop(0)
+                        self._clock.finish()
+                        _, self._timeline, self._clock, self._cursor, _ = \
+                            self._runs[0]
+                        self._next = None
+                        self._adopt_run()
+                        continue
+                    segment_start, jumps = self._cursor, self._jumps
+                    segment = self._segment[:self._segment_wanted()]
+                    self._ring.read_into(segment)
+                    self._backend.play(segment)
+                    self._clock.begin_segment(segment_start, len(segment),
+                                              self._backend)
+                    self._cond.notify_all()  # 腾出了空间，合成线程继续写
+                self._first_sound.set()
+                # 当前块播放期间，合成线程继续准备后面的块
+                self._backend.wait_done()
+                with self._cond:
+                    if self._jumps == jumps:  # 正常播完，没有被暂停/跳转打断
+                        self._cursor = segment_start + len(segment)
+                        self._clock.end_segment()
+                        self._cond.notify_all()
+        finally:
+            self._clock.finish()
+            self._first_sound.set()
+
+    @property
+    def paused(self):
+        return self._paused
+
+    def metrics(self):
+        # 环形缓冲区的容量、最低水位和下溢次数
+        return self._ring.metrics()
+
+    def _interrupt(self, sample, paused):
+        # 调用方已持有锁：移动播放位置并打断正在播放的块
+        self._cursor = min(max(0, int(sample)), self._timeline.total_samples)
+        self._paused = paused
+        self._jumps += 1
+        self._clock.jump(self._cursor, paused)
+        self._backend.stop()
+        self._cond.notify_all()
+
+    def pause(self):
+        with self._cond:
+            if not self._paused and not self._stopped:
+                self._backend.stop()  # 先停住后端，暂停位置就是实际播到的采样
+                self._interrupt(self._clock.position(), True)
+
+    def resume(self):
+        with self._cond:
+            if self._paused and not self._stopped:
+                self._interrupt(self._cursor, False)
+
+    def toggle_pause(self):
+        with self._cond:
+            if self._paused:
+                self.resume()
+            else:
+                self.pause()
+
+    def seek(self, sample):
+        # 跳到曲中任意采样；暂停中跳转则保持暂停
+        with self._cond:
+            if not self._stopped:
+                self._interrupt(sample, self._paused)
+
+    def expect_next(self):
+        # 后面还有歌：当前曲目播完先等 queue_next，不要直接结束
+        with self._cond:
+            self._more_songs = True
+
+    def queue_next(self, timeline, clock, more_songs=False):
+        with self._cond:
+            self._next = (timeline, clock)
+            self._more_songs = more_songs
+            self._cond.notify_all()
+
+    def end_of_playlist(self):
+        with self._cond:
+            self._more_songs = False
+            self._cond.notify_all()
+
+    def wait_done(self):
+        self._feeder.join()
+
+    def close(self):
+        # 停止并等两个线程退出后再收尾缓冲区（完整合成过的才写进缓存）
+        self.stop()
+        for thread in (self._producer, self._feeder):
+            if thread.ident is not None:
+                thread.join()
+        self._timeline.close()
+        if self._next is not None:
+            self._next[0].close()
+        self._backend.close()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+            self._backend.stop()
+        self._first_sound.set()  # 还没出声就被停止时，让 start() 立即返回
+
+
+# ===================== 播放状态（每个播放器一份，替代全局变量） =====================
+class PlaybackState:
+    # 一次播放的乐谱与全部可变状态。字段只通过 set_* 修改，
+    # 修改后唤醒等待者：线程用条件变量，协程用 asyncio.Event。
+    # 不共享任何模块级变量，同一进程里可以同时存在多个播放器
+
+    def __init__(self, tracks, cached_pcm=None, score_hash=None, title=""):
+        self.tracks = tracks  # 全部音轨（Score 列表，用于合成）
+        self.notes = tracks[0]  # 第一条音轨（用于五线谱显示与同步）
+        self.cached_pcm = cached_pcm  # 磁盘缓存中的整曲PCM，没有则为None
+        self.score_hash = score_hash  # 乐谱内容哈希（缓存键）
+        self.title = title  # 播放列表里显示的曲名，单曲播放为空
+        self.clock = PlaybackClock()  # 声卡实际播放位置
+        self.term_width = terminal_width()
+        self._lock = threading.Lock()
+        self._note_idx = 0
+        self._playing = False
+        self._typing = False
+        self._paused = False
+        self._typed_lines = []  # 打字机已打出的每一行（用于保留）
+        self._loop = None
+        self._changed = None
+        self._clock_events = []
+        self.clock.subscribe(self._on_clock_jump)
+
+    def bind_loop(self):
+        # 在事件循环里调用一次，之后的修改也会唤醒 wait_changed 的协程
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+
+    def clock_event(self):
+        # 每个协程各要一个：播放时钟暂停/继续/跳转/结束时被置位
+        event = asyncio.Event()
+        self._clock_events.append(event)
+        return event
+
+    def _on_clock_jump(self):
+        if self._loop is None:
+            return
+        try:
+            for event in self._clock_events:
+                self._loop.call_soon_threadsafe(event.set)
+        except RuntimeError:
+            pass  # 事件循环已关闭（播放结束后送声线程才退出）
+
+    @property
+    def note_idx(self):
+        return self._note_idx
+
+    @property
+    def playing(self):
+        return self._playing
+
+    @property
+    def typing(self):
+        return self._typing
+
+    @property
+    def paused(self):
+        return self._paused
+
+    @property
+    def typed_lines(self):
+        with self._lock:
+            return list(self._typed_lines)
+
+    def _snapshot(self):
+        return self._note_idx, self._playing, self._typing, self._paused
+
+    def snapshot(self):
+        # (当前音符序号, 是否播放中, 打字机是否运行中, 是否暂停)
+        with self._lock:
+            return self._snapshot()
+
+    def _update(self, **fields):
+        with self._lock:
+            before = self._snapshot()
+            for name, value in fields.items():
+                setattr(self, "_" + name, value)
+            if self._snapshot() == before:
+                return  # 只改了打字机文本之类不影响画面的字段，不打扰等待者
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._changed.set)
+
+    def set_note_idx(self, note_idx):
+        self._update(note_idx=note_idx)
+
+    def set_playing(self, playing):
+        self._update(playing=playing)
+
+    def set_paused(self, paused):
+        self._update(paused=paused)
+
+    def set_typing(self, typing, typed_lines):
+        self._update(typing=typing, typed_lines=list(typed_lines))
+
+    def set_typed_lines(self, typed_lines):
+        self._update(typed_lines=list(typed_lines))
+
+    async def wait_changed(self, last_snapshot):
+        # 挂起直到快照与 last_snapshot 不同（先清标志再检查，不会漏掉通知）
+        while True:
+            self._changed.clear()
+            current = self.snapshot()
+            if current != last_snapshot:
+                return current
+            await self._changed.wait()
+
+
+# ===================== 播放调度（单个 asyncio 事件循环，按截止时间唤醒） =====================
+async def sleep_until_sample(clock, target_sample, clock_jumped):
+    # 睡到播放时钟走到 target_sample；时钟在块间空隙停住时醒来再算一次。
+    # 暂停/跳转/结束会置位 clock_jumped，立即返回让调用方重新计算
+    while not clock.finished:
+        if clock_jumped.is_set():
+            return
+        remaining = target_sample - clock.position()
+        if remaining <= 0:
+            return
+        # 暂停中时钟不走，只等跳变
+        timeout = None if clock.paused else max(remaining / SAMPLE_RATE, 0.001)
+        try:
+            await asyncio.wait_for(clock_jumped.wait(), timeout)
+        except asyncio.TimeoutError:
+            continue
+
+
+def playback_timeline(state):
+    if state.cached_pcm is not None:
+        # 命中磁盘缓存：跳过合成，直接播放内存映射的PCM
+        return ScoreTimeline(state.tracks, pcm=state.cached_pcm)
+    cache_path = None
+    if SCORE_CACHE_ENABLED and state.score_hash:
+        try:
+            os.makedirs(score_cache_dir(state.score_hash), exist_ok=True)
+            cache_path = os.path.join(score_cache_dir(state.score_hash),
+                                      "pcm.npy")
+        except OSError:
+            pass  # 缓存只是加速，目录建不了就不写
+    return ScoreTimeline(state.tracks, cache_path=cache_path)
+
+
+async def note_sync_task(state):
+    # 每个音符的起始采样在编译乐谱时已算好，这里只转成列表供二分查找
+    note_offsets = state.notes.offsets.tolist()
+    end_sample = state.notes.end_sample
+    clock_jumped = state.clock_event()
+    while not state.clock.finished:
+        clock_jumped.clear()
+        elapsed_samples = state.clock.position()
+        # O(log n)：最后一个起点 <= 当前采样位置的音符（跳转后也立即对上）
+        note_idx = max(0,
+                       bisect.bisect_right(note_offsets, elapsed_samples) - 1)
+        state.set_note_idx(min(note_idx, len(note_offsets) - 1))
+        # 一直睡到下一个音符开始（或暂停/跳转），中间不轮询；
+        # 第一条音轨播完后只等结束或跳转（其他音轨可能更长）
+        if note_idx + 1 < len(note_offsets):
+            next_sample = note_offsets[note_idx + 1]
+        elif elapsed_samples < end_sample:
+            next_sample = end_sample
+        else:
+            next_sample = float('inf')
+        await sleep_until_sample(state.clock, next_sample, clock_jumped)
+
+
+# ===================== 键盘控制（非阻塞读取：暂停/继续/跳转） =====================
+SEEK_STEP_SECONDS = 5  # ←/→ 每次后退/前进的秒数
+KEY_HELP = (f" 空格 暂停/继续 | ←/→ 后退/前进{SEEK_STEP_SECONDS}秒 | ,/. 上/下一个音符 | "
+            "数字+回车 跳到第N个音符 ")
+ESCAPE_KEYS = {"\x1b[D": 'left', "\x1b[C": 'right', "\x1bOD": 'left',
+               "\x1bOC": 'right'}
+WINDOWS_ARROW_KEYS = {'K': 'left', 'M': 'right'}
+
+
+def split_keys(text):
+    # 把一次读到的输入拆成按键：方向键是多字节的转义序列
+    keys = []
+    pos = 0
+    while pos < len(text):
+        for sequence, key in ESCAPE_KEYS.items():
+            if text.startswith(sequence, pos):
+                keys.append(key)
+                pos += len(sequence)
+                break
+        else:
+            keys.append(text[pos])
+            pos += 1
+    return keys
+
+
+class KeyboardInput:
+    # 终端切到 cbreak 模式（按键不用回车、不回显），由事件循环在 stdin 可读时回调；
+    # Windows 没有 termios，改为定时检查 msvcrt.kbhit()。stdin 不是终端时不做任何事
+    def __init__(self, on_key):
+        self._on_key = on_key
+        self._fd = None
+        self._saved_attrs = None
+        self._poll_task = None
+
+    def __enter__(self):
+        if not sys.stdin.isatty():
+            return self
+        loop = asyncio.get_running_loop()
+        if termios is not None:
+            self._fd = sys.stdin.fileno()
+            self._saved_attrs = termios.tcgetattr(self._fd)
+            tty.setcbreak(self._fd)
+            loop.add_reader(self._fd, self._read)
+        elif msvcrt is not None:
+            self._poll_task = loop.create_task(self._poll_windows())
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._fd is not None:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            termios.tcsetattr(self._fd, termios.TCSADRAIN, self._saved_attrs)
+            self._fd = None
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+
+    def _read(self):
+        text = os.read(self._fd, 64).decode("utf-8", errors="ignore")
+        for key in split_keys(text):
+            self._on_key(key)
+
+    async def _poll_windows(self):
+        while True:
+            while msvcrt.kbhit():
+                key = msvcrt.getwch()
+                if key in ("\x00", "\xe0"):  # 方向键：前缀 + 扫描码
+                    key = WINDOWS_ARROW_KEYS.get(msvcrt.getwch(), "")
+                if key:
+                    self._on_key(key)
+            await asyncio.sleep(0.05)
+
+
+def seek_to_note(state, player, note_idx):
+    # 音符序号 → 起始采样：编译乐谱时已算好的 offset，O(1)
+    note_idx = min(max(0, note_idx), len(state.notes) - 1)
+    player.seek(int(state.notes.offsets[note_idx]))
+
+
+def seek_to_time(player, seconds):
+    player.seek(int(round(max(0.0, seconds) * SAMPLE_RATE)))
+
+
+def make_key_handler(state, player):
+    typed_digits = []
+
+    def on_key(key):
+        if key == " ":
+            player.toggle_pause()
+            state.set_paused(player.paused)
+        elif key == 'left':
+            seek_to_time(player,
+                         state.clock.position() / SAMPLE_RATE - SEEK_STEP_SECONDS)
+        elif key == 'right':
+            seek_to_time(player,
+                         state.clock.position() / SAMPLE_RATE + SEEK_STEP_SECONDS)
+        elif key == ",":
+            seek_to_note(state, player, state.note_idx - 1)
+        elif key == ".":
+            seek_to_note(state, player, state.note_idx + 1)
+        elif key.isdigit():
+            typed_digits.append(key)
+        elif key in ("\r", "\n") and typed_digits:
+            seek_to_note(state, player, int("".join(typed_digits)) - 1)
+            typed_digits.clear()
+        else:
+            typed_digits.clear()
+
+    return on_key
+
+
+# ===================== 差分渲染（只重写变化的格子，每帧一次写出） =====================
+def char_width(char):
+    # 中日韩文字、全角符号占两列，其余按一列
+    return 2 if unicodedata.east_asian_width(char) in ('W', 'F') else 1
+
+
+def text_width(text):
+    return sum(char_width(char) for char in text)
+
+
+def clip_text(text, width):
+    # 截到不超过 width 列（放不下的宽字符整个丢掉）
+    used = 0
+    for idx, char in enumerate(text):
+        used += char_width(char)
+        if used > width:
+            return text[:idx]
+    return text
+
+
+def center_text(text, width, fill=" "):
+    # 按显示宽度居中并补满 width 列；str.center 按字符数算，中文会多出一截而折行
+    text = clip_text(text, width)
+    padding = width - text_width(text)
+    return fill * (padding // 2) + text + fill * (padding - padding // 2)
+
+
+class ScreenRegion:
+    # 终端上从 first_row 起 row_count 行、宽 width 列的一块区域的帧缓冲。
+    # 每帧先在格子上画好（fill_row / put），render() 与上一帧逐格比较，只输出变化的格子：
+    # 同一行里隔得近的直接把中间没变的格子重写一遍（比转义序列短），
+    # 否则光标右移或绝对定位。整帧拼成一个字符串一次写出、一次 flush。
+    # 格子是 (字符, 样式)，宽字符的第二格为 None；样式是 SGR 前缀（如红色 "\033[31m"）
+    def __init__(self, first_row, row_count, width):
+        self.first_row = first_row
+        self.row_count = row_count
+        self.width = width
+        self._cells = [[(' ', '')] * width for _ in range(row_count)]
+        self._shown = None  # 屏幕上现在的样子；None 表示下一帧整块重画
+        self.frames = 0
+        self.bytes_written = 0
+
+    def invalidate(self):
+        # 区域被别处改写过（如重画边框）时调用
+        self._shown = None
+
+    def fill_row(self, row, char=' ', style=''):
+        self._cells[row] = [(char, style)] * self.width
+
+    def put(self, row, col, text, style=''):
+        row_cells = self._cells[row]
+        for char in text:
+            char_cols = char_width(char)
+            if 0 <= col and col + char_cols <= self.width:
+                # 压住宽字符的半边时，把另外半边补成空格
+                if row_cells[col] is None:
+                    row_cells[col - 1] = (' ', '')
+                tail = col + char_cols
+                if tail < self.width and row_cells[tail] is None:
+                    row_cells[tail] = (' ', '')
+                row_cells[col] = (char, style)
+                if char_cols == 2:
+                    row_cells[col + 1] = None
+            col += char_cols
+
+    def render(self):
+        out = []
+        cursor = None  # 终端光标所在的 (行, 列)，未知为 None
+        style = None  # 终端当前生效的样式，未知为 None
+        for row, row_cells in enumerate(self._cells):
+            if self._shown is None:
+                changed_cols = range(self.width)
+            elif self._shown[row] == row_cells:
+                continue  # 整行没变
+            else:
+                changed_cols = [
+                    col for col, (cell, shown_cell) in enumerate(
+                        zip(row_cells, self._shown[row])) if cell != shown_cell
+                ]
+            next_col = 0
+            for col in changed_cols:
+                if row_cells[col] is None:
+                    col -= 1  # 宽字符的第二格变了：从第一格起重写
+                if col < next_col:
+                    continue  # 已随前一个宽字符写过
+                char, cell_style = row_cells[col]
+                if cursor != (row, col):
+                    out.append(self._move(cursor, row, col, style))
+                if cell_style != style:
+                    out.append("\033[0m" + cell_style)
+                    style = cell_style
+                out.append(char)
+                next_col = col + (2 if col + 1 < self.width
+                                  and row_cells[col + 1] is None else 1)
+                cursor = (row, next_col)
+        if style:
+            out.append("\033[0m")
+        self._shown = [list(row_cells) for row_cells in self._cells]
+
+        frame = "".join(out)
+        frame_bytes = len(frame.encode("utf-8"))
+        if frame:
+            sys.stdout.write(frame)
+            sys.stdout.flush()
+        self.frames += 1
+        self.bytes_written += frame_bytes
+        return frame_bytes
+
+    def _move(self, cursor, row, col, style):
+        # 从 cursor 移到 (row, col) 的最短写法
+        jump = f"\033[{self.first_row + row};{col + 1}H"
+        if cursor is None or cursor[0] != row or cursor[1] > col:
+            return jump
+        gap_cells = self._cells[row][cursor[1]:col]
+        if all(cell is None or cell[1] == style for cell in gap_cells):
+            # 中间没变的格子原样重写一遍
+            gap_text = "".join(cell[0] for cell in gap_cells if cell is not None)
+            if len(gap_text.encode("utf-8")) <= min(len(jump), 4):
+                return gap_text
+        forward = f"\033[{col - cursor[1]}C"
+        return forward if len(forward) < len(jump) else jump
 
-        # 初始化进度行
-        progress_row = fixed_lines['progress']
-        sys.stdout.write(f"\033[{progress_row};1H")
-        sys.stdout.write(" " * term_width)
 
-        # 初始化底部边框
-        bottom_border_row = fixed_lines['border_bottom']
-        sys.stdout.write(f"\033[{bottom_border_row};1H")
-        sys.stdout.write("=" * term_width)
+# ===================== 五线谱可视化（关键：在打字机下方更新，不覆盖） =====================
+def init_staff_frame(term_width):
+    # 打印五线谱顶部边框（与打字机隔1行）
+    border_row = fixed_lines['staff_start'] - 1
+    sys.stdout.write(f"\033[{border_row};1H")
+    sys.stdout.write("=" * term_width)
+
+    # 打印五线谱标题
+    title_row = fixed_lines['staff_start']
+    sys.stdout.write(f"\033[{title_row};1H")
+    sys.stdout.write(
+        center_text("🎵 五线谱播放区 | 当前播放：红色音符 | 按Ctrl+C停止",
+                    term_width).replace("红色音符", "\033[31m红色音符\033[0m"))
+
+    # 打印五线谱中间边框
+    mid_border_row = fixed_lines['staff_start'] + 1
+    sys.stdout.write(f"\033[{mid_border_row};1H")
+    sys.stdout.write("-" * term_width)
+
+    # 初始化五线谱空白框架
+    for i in range(STAFF_TOTAL_LINES):
+        staff_row = fixed_lines['staff_start'] + 2 + i
+        sys.stdout.write(f"\033[{staff_row};1H")
+        if i in STAFF_LINE_ROWS:
+            sys.stdout.write(STAFF_LINE_CHAR * term_width)
+        else:
+            sys.stdout.write(" " * term_width)
 
-        sys.stdout.flush()
+    # 初始化进度行
+    progress_row = fixed_lines['progress']
+    sys.stdout.write(f"\033[{progress_row};1H")
+    sys.stdout.write(" " * term_width)
 
-    # 先初始化五线谱框架
-    init_staff_frame()
-
-    # 动态更新音符和进度（仅操作五线谱区域，不碰打字机区域）
-    while is_playing_flag:
-        # 1. 清空上一帧音符（仅五线谱区域）
-        for i in range(STAFF_TOTAL_LINES):
-            staff_row = fixed_lines['staff_start'] + 2 + i
-            terminal_row = staff_row
-            sys.stdout.write(f"\033[{terminal_row};1H")
-            if i in STAFF_LINE_ROWS:
-                sys.stdout.write(STAFF_LINE_CHAR * term_width)
-            else:
-                sys.stdout.write(" " * term_width)
-
-        # 2. 计算音符显示范围
-        start_idx = max(0, current_note_idx - CUSTOM_DISPLAY_RANGE)
-        end_idx = min(len(music_notes),
-                      current_note_idx + CUSTOM_DISPLAY_RANGE + 1)
-        center_col = term_width // 2
-        base_col = center_col - (current_note_idx -
-                                 start_idx) * CUSTOM_NOTE_WIDTH
-
-        # 3. 绘制当前音符
-        for note_idx in range(start_idx, end_idx):
-            note_code, _ = music_notes[note_idx]
-            note_info = NOTE_POSITION_MAP[note_code]
-            note_sym = note_info['symbol']
-            note_pos = note_info['pos']
-
-            # 映射五线谱行（相对于五线谱框架）
-            staff_grid_row = POSITION_TO_ROW.get(note_pos, 5)
-            terminal_row = fixed_lines['staff_start'] + 2 + staff_grid_row
-            note_start_col = base_col + (note_idx -
-                                         start_idx) * CUSTOM_NOTE_WIDTH
-
-            # 确保音符在终端范围内
-            if 0 < note_start_col < term_width - CUSTOM_NOTE_WIDTH:
-                sys.stdout.write(f"\033[{terminal_row};{note_start_col}H")
-                if note_idx == current_note_idx:
-                    # 红色高亮当前音符
-                    sys.stdout.write(
-                        f"\033[31m{note_sym * CUSTOM_NOTE_WIDTH}\033[0m")
-                else:
-                    sys.stdout.write(note_sym * CUSTOM_NOTE_WIDTH)
+    # 初始化底部边框（附按键说明）
+    bottom_border_row = fixed_lines['border_bottom']
+    sys.stdout.write(f"\033[{bottom_border_row};1H")
+    sys.stdout.write(center_text(KEY_HELP, term_width, "="))
 
-        # 4. 更新进度行（不覆盖打字机）
-        progress_text = f"播放进度：{current_note_idx + 1}/{len(music_notes)} | 打字机：{'运行中' if is_typing_flag else '已完成'}"
-        progress_col = (term_width - len(progress_text)) // 2
-        progress_row = fixed_lines['progress']
-        sys.stdout.write(f"\033[{progress_row};1H")
-        sys.stdout.write(" " * term_width)
-        sys.stdout.write(f"\033[{progress_row};{progress_col}H{progress_text}")
+    sys.stdout.flush()
 
-        sys.stdout.flush()
-        time.sleep(0.05)
 
-    # 播放结束提示
+def staff_screen(term_width):
+    # 五线谱网格 + 进度行，由差分渲染独占这几行
+    return ScreenRegion(fixed_lines['staff_start'] + 2, STAFF_TOTAL_LINES + 1,
+                        term_width)
+
+
+def draw_staff(state, screen, playing_idx, is_typing, is_paused):
+    # 在 screen 上画一帧并只写出变化的部分，返回写出的字节数
+    music_notes, term_width = state.notes, state.term_width
+
+    # 1. 五线谱底图（横线与空白行）
+    for i in range(STAFF_TOTAL_LINES):
+        screen.fill_row(i, STAFF_LINE_CHAR if i in STAFF_LINE_ROWS else " ")
+
+    # 2. 计算音符显示范围
+    start_idx = max(0, playing_idx - CUSTOM_DISPLAY_RANGE)
+    end_idx = min(len(music_notes), playing_idx + CUSTOM_DISPLAY_RANGE + 1)
+    center_col = term_width // 2
+    base_col = center_col - (playing_idx - start_idx) * CUSTOM_NOTE_WIDTH
+
+    # 3. 绘制当前音符（切片为视图，不复制乐谱）
+    visible_pitches = music_notes[start_idx:end_idx].pitches.tolist()
+    for note_idx, pitch in enumerate(visible_pitches, start_idx):
+        note_start_col = base_col + (note_idx - start_idx) * CUSTOM_NOTE_WIDTH
+        # 确保音符在终端范围内（列号从1起）
+        if 0 < note_start_col < term_width - CUSTOM_NOTE_WIDTH:
+            # 红色高亮当前音符
+            screen.put(PITCH_STAFF_ROWS[pitch], note_start_col - 1,
+                       PITCH_SYMBOLS[pitch] * CUSTOM_NOTE_WIDTH,
+                       "\033[31m" if note_idx == playing_idx else "")
+
+    # 4. 更新进度行（不覆盖打字机）
+    title_text = f"{state.title} | " if state.title else ""
+    progress_text = f"{'⏸ 已暂停 | ' if is_paused else ''}{title_text}播放进度：{playing_idx + 1}/{len(music_notes)} | 打字机：{'运行中' if is_typing else '已完成'}"
+    progress_col = (term_width - text_width(progress_text)) // 2
+    screen.fill_row(STAFF_TOTAL_LINES)
+    screen.put(STAFF_TOTAL_LINES, max(progress_col, 0), progress_text)
+
+    return screen.render()
+
+
+def draw_end_message(term_width):
     end_text = "🎶 播放结束！感谢聆听～ | 📝 文本打印完成"
-    end_col = (term_width - len(end_text)) // 2
+    end_col = max((term_width - text_width(end_text)) // 2, 0) + 1  # CUP 列号从1起
     progress_row = fixed_lines['progress']
     sys.stdout.write(f"\033[{progress_row};1H")
     sys.stdout.write(" " * term_width)
     sys.stdout.write(f"\033[{progress_row};{end_col}H{end_text}")
     sys.stdout.flush()
-    time.sleep(4)  # 延长停留时间，方便查看
 
 
-# ===================== 主控制（原功能） =====================
-def start_music_with_staff():
-    global current_note_idx, is_playing_flag
-    current_note_idx = 0
-    is_playing_flag = False
+async def staff_task(state):
+    # 阻塞到音符切换或打字机状态变化才重画一帧，其余时间不占CPU
+    init_staff_frame(state.term_width)
+    screen = staff_screen(state.term_width)
+    snapshot = None
+    while True:
+        snapshot = await state.wait_changed(snapshot)
+        note_idx, _, is_typing, is_paused = snapshot
+        frame = runtime_stats.begin_frame()
+        frame_bytes = draw_staff(state, screen, note_idx, is_typing, is_paused)
+        if frame is not None:
+            # 画完时距这个音符开始已过了多久
+            late_samples = state.clock.position() - state.notes.offsets[note_idx]
+            runtime_stats.end_frame(frame, late_samples / SAMPLE_RATE * 1e3,
+                                    frame_bytes)
+
+
+# ===================== 乐谱解析（逐行流式解析，不再 eval） =====================
+# 乐谱格式：每行一个 ('C4', 2)；和弦写作 (('C4', 'E4', 'G4'), 2)；时值可写作 1/2
+# 以「[音轨名]」开头的行开始一条新音轨（如伴奏），第一条音轨为主旋律
+# 其他不以「(」开头的行（空行、说明文字）忽略；行尾可跟「# 注释」
+NOTE_LINE_PATTERN = re.compile(
+    r"""\(\s*(['"])([^'"]*)\1\s*,\s*(\d+(?:\.\d*)?|\.\d+)\s*\)\s*,?\s*(?:#.*)?$""")
+# 整块匹配用：一次 findall 解析成千上万行单音，不在 Python 里逐行循环
+NOTE_BLOCK_PATTERN = re.compile(
+    r"""^[ \t]*\([ \t]*(['"])([^'"\n]*)\1[ \t]*,[ \t]*(\d+(?:\.\d*)?|\.\d+)[ \t]*\)[ \t]*,?[ \t]*(?:#[^\n]*)?$""",
+    re.M)
+NOTE_START_PATTERN = re.compile(r"^[^\S\n]*\(", re.M)
+# 音轨头 [名称] 或速度标记 @tempo：出现时不走整块快速路径
+DIRECTIVE_PATTERN = re.compile(r"^[^\S\n]*[\[@]", re.M)
+TEMPO_LINE_PATTERN = re.compile(
+    r"@tempo\s+(\d+(?:\.\d*)?|\.\d+)\s*(?:#.*)?$")  # @tempo 120（拍/分钟）
+PARSE_BLOCK_LINES = 4096  # 每次整块解析的行数（决定解析时的内存占用）
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d*)?|\.\d+)(?:\s*/\s*(\d+(?:\.\d*)?|\.\d+))?")
+
+
+class ScoreSyntaxError(SyntaxError):
+
+    def __init__(self, msg, source, lineno, col, line):
+        super().__init__(msg, (source, lineno, col, line))
+
+
+def parse_note_tokens(line, lineno, source):
+    # 通用（慢）路径：和弦、分数时值，以及给出出错的行列位置
+    pos = 0
+
+    def error(msg):
+        raise ScoreSyntaxError(msg, source, lineno, pos + 1, line)
+
+    def skip_spaces():
+        nonlocal pos
+        while pos < len(line) and line[pos] in " \t":
+            pos += 1
+
+    def expect(char):
+        nonlocal pos
+        skip_spaces()
+        if pos >= len(line) or line[pos] != char:
+            error(f"此处应为「{char}」")
+        pos += 1
+
+    def parse_name():
+        nonlocal pos
+        skip_spaces()
+        if pos >= len(line) or line[pos] not in "'\"":
+            error("此处应为带引号的音名，如 'C4'")
+        name_end = line.find(line[pos], pos + 1)
+        if name_end < 0:
+            error("音名缺少结束引号")
+        name_col = pos + 1
+        pos = name_end + 1
+        return line[name_col:name_end], name_col
+
+    expect("(")
+    skip_spaces()
+    if pos < len(line) and line[pos] in "([":
+        # 和弦：('C4', 'E4', 'G4') 或 ['C4', 'E4', 'G4']
+        closer = ")" if line[pos] == "(" else "]"
+        pos += 1
+        names = [parse_name()]
+        while True:
+            skip_spaces()
+            if pos < len(line) and line[pos] == closer:
+                pos += 1
+                break
+            if pos >= len(line) or line[pos] != ",":
+                error(f"和弦中此处应为「,」或「{closer}」")
+            pos += 1
+            skip_spaces()
+            if pos < len(line) and line[pos] == closer:
+                pos += 1  # 允许和弦末尾多一个逗号
+                break
+            names.append(parse_name())
+    else:
+        names = [parse_name()]
+
+    expect(",")
+    skip_spaces()
+    dur_col = pos + 1
+    dur_match = DURATION_PATTERN.match(line, pos)
+    if not dur_match:
+        error("此处应为时值（正数，可写作 1/2）")
+    numerator, denominator = dur_match.groups()
+    if denominator is not None and float(denominator) == 0:
+        error("时值的分母不能为0")
+    dur = float(numerator) / float(denominator or 1)
+    pos = dur_match.end()
+
+    expect(")")
+    skip_spaces()
+    if pos < len(line) and line[pos] == ",":
+        pos += 1
+        skip_spaces()
+    if pos < len(line) and line[pos] != "#":
+        error("行尾有多余内容")
+    return names, dur, dur_col
+
+
+def parse_note_block(block_lines, track):
+    # 整块快速路径：块内只有单音行时一次解析完；有音轨头、和弦、
+    # 未知音符或错误时返回 False，交给逐行解析给出精确位置
+    block_text = "".join(block_lines)
+    note_matches = NOTE_BLOCK_PATTERN.findall(block_text)
+    # 每行都是单音时无需再检查；否则确认块内没有音轨头、且没有漏掉的音符行
+    if len(note_matches) != len(block_lines) and (
+            DIRECTIVE_PATTERN.search(block_text) or len(note_matches) !=
+            len(NOTE_START_PATTERN.findall(block_text))):
+        return False
+    try:
+        pitches = [PITCH_BY_NAME[name] for _, name, _ in note_matches]
+    except KeyError:
+        return False
+    durations = [float(dur) for _, _, dur in note_matches]
+    if durations and min(durations) <= 0:
+        return False
+    track[0].extend(pitches)
+    track[1].extend(durations)
+    return True
+
+
+def parse_note_lines(block_lines, first_lineno, tracks, tempo_changes, source):
+    for lineno, raw_line in enumerate(block_lines, first_lineno):
+        line = raw_line.strip()
+        if line.startswith("["):
+            if tracks[-1][0]:
+                tracks.append(([], [], {}))
+            continue
+        if line.startswith("@"):
+            col_base = len(raw_line) - len(raw_line.lstrip())
+            tempo_match = TEMPO_LINE_PATTERN.match(line)
+            if not tempo_match:
+                raise ScoreSyntaxError("速度标记应写作 @tempo 120", source, lineno,
+                                       col_base + 1, raw_line.rstrip("\r\n"))
+            bpm = float(tempo_match.group(1))
+            if not bpm > 0:
+                raise ValueError(f"第{lineno}行第{col_base + tempo_match.start(1) + 1}"
+                                 f"列：速度必须为正数")
+            # 速度变化对所有音轨生效，位置是当前音轨已写到的拍数
+            tempo_changes.append((sum(tracks[-1][1]), bpm))
+            continue
+        if not line.startswith("("):
+            continue
+
+        note_match = NOTE_LINE_PATTERN.match(line)
+        if note_match:
+            # 快速路径：最常见的单音写法，一次正则匹配完成
+            col_base = len(raw_line) - len(raw_line.lstrip())
+            names = [(note_match.group(2), col_base + note_match.start(2) + 1)]
+            dur = float(note_match.group(3))
+            dur_col = col_base + note_match.start(3) + 1
+        else:
+            names, dur, dur_col = parse_note_tokens(raw_line.rstrip("\r\n"),
+                                                    lineno, source)
+
+        pitches = []
+        for name, name_col in names:
+            try:
+                pitches.append(parse_pitch(name))
+            except ValueError as e:
+                raise ValueError(f"第{lineno}行第{name_col}列：{e}") from None
+        if not dur > 0:
+            raise ValueError(f"第{lineno}行第{dur_col}列：时长必须为正数")
+
+        track_pitches, track_durations, track_chords = tracks[-1]
+        if len(pitches) > 1:
+            track_chords[len(track_pitches)] = pitches[1:]
+        track_pitches.append(pitches[0])
+        track_durations.append(dur)
+
+
+def parse_score(lines, source="<score>"):
+    # 每条音轨：主音列表、时值列表、{事件序号: 和弦其余音}
+    tracks = [([], [], {})]
+    tempo_changes = []  # [(拍位置, BPM), ...]
+    lines = iter(lines)
+    first_lineno = 1
+    while True:
+        # 按块流式读取，内存占用与文件大小无关
+        block_lines = list(itertools.islice(lines, PARSE_BLOCK_LINES))
+        if not block_lines:
+            break
+        if not parse_note_block(block_lines, tracks[-1]):
+            parse_note_lines(block_lines, first_lineno, tracks, tempo_changes,
+                             source)
+        first_lineno += len(block_lines)
+
+    tempo_map = make_tempo_map(tempo_changes)
+    scores = []
+    for track_pitches, track_durations, track_chords in tracks:
+        if not track_pitches and scores:
+            continue
+        chords = None
+        if track_chords:
+            chord_width = max(len(extra) for extra in track_chords.values())
+            chords = np.zeros((len(track_pitches), chord_width), dtype=np.uint8)
+            for idx, extra in track_chords.items():
+                chords[idx, :len(extra)] = extra
+        scores.append(
+            Score.from_arrays(np.array(track_pitches, dtype=np.uint8),
+                              track_durations, chords, tempo_map))
+    return scores
+
+
+def load_score(score_path=DEFAULT_SCORE_PATH):
+    if os.path.splitext(score_path)[1].lower() in MIDI_EXTENSIONS:
+        with open(score_path, "rb") as f:
+            return parse_midi(f.read())
+    with open(score_path, "r", encoding="utf-8") as f:
+        return parse_score(f, score_path)
+
+
+# ===================== MIDI 导入/导出（标准MIDI文件） =====================
+MIDI_EXTENSIONS = (".mid", ".midi")
+MIDI_EXPORT_DIVISION = 480  # 导出时每个四分音符的tick数
+MIDI_EXPORT_VELOCITY = 96
+MIDI_DRUM_CHANNEL = 9  # 第10通道是打击乐，没有音高，导入时跳过
+MIDI_MAX_CHORD_NOTES = 8  # 同一时刻超过这么多音的只保留最高的几个
+MIDI_MAX_VOICES = 8  # 一条音轨最多拆成几个声部，再多时最早结束的声部被截断让位
+MIDI_DEFAULT_TEMPO = 500000  # 微秒/四分音符（120 BPM），文件未指定时使用
+# 各类通道消息的数据字节数（按状态字节高4位）
+MIDI_DATA_LENGTHS = {0x8: 2, 0x9: 2, 0xA: 2, 0xB: 2, 0xC: 1, 0xD: 1, 0xE: 2}
+
+
+def parse_midi_track(data, pos, end, tempo_ticks, tempo_values):
+    # 逐字节扫描一个MTrk块，音符只记入 array，不为每个事件创建对象
+    starts, ends, pitches = array('q'), array('q'), array('B')
+    active = {}  # (通道<<7 | 音高) -> 尚未结束的音符在数组中的下标列表
+    tick = 0
+    status = 0
+    while pos < end:
+        delta = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            delta = (delta << 7) | (byte & 0x7F)
+            if byte < 0x80:
+                break
+        tick += delta
+
+        if data[pos] & 0x80:
+            status = data[pos]
+            pos += 1
+        elif status == 0 or status >= 0xF0:
+            raise ValueError(f"MIDI文件损坏：第{pos}字节缺少状态字节")
+
+        if status == 0xFF:
+            meta_type = data[pos]
+            pos += 1
+            length = 0
+            while True:
+                byte = data[pos]
+                pos += 1
+                length = (length << 7) | (byte & 0x7F)
+                if byte < 0x80:
+                    break
+            if meta_type == 0x51 and length == 3:
+                tempo_ticks.append(tick)
+                tempo_values.append(int.from_bytes(data[pos:pos + 3], "big"))
+            elif meta_type == 0x2F:
+                pos = end
+                break
+            pos += length
+            status = 0  # 元事件/系统独占消息会清除running status
+            continue
+        if status in (0xF0, 0xF7):
+            length = 0
+            while True:
+                byte = data[pos]
+                pos += 1
+                length = (length << 7) | (byte & 0x7F)
+                if byte < 0x80:
+                    break
+            pos += length
+            status = 0
+            continue
+
+        kind = status >> 4
+        if kind == 0x9 or kind == 0x8:
+            pitch = data[pos]
+            velocity = data[pos + 1]
+            pos += 2
+            channel = status & 0x0F
+            if channel == MIDI_DRUM_CHANNEL:
+                continue
+            key = (channel << 7) | pitch
+            if kind == 0x9 and velocity > 0:
+                active.setdefault(key, []).append(len(starts))
+                starts.append(tick)
+                ends.append(-1)
+                pitches.append(pitch)
+            elif active.get(key):
+                # 同音重叠时按先开先关配对
+                ends[active[key].pop(0)] = tick
+        else:
+            pos += MIDI_DATA_LENGTHS[kind]
+
+    # 没有note-off的音符延续到音轨结尾
+    for open_notes in active.values():
+        for idx in open_notes:
+            ends[idx] = tick
+    return starts, ends, pitches
+
+
+def fold_midi_pitches(pitches):
+    # 钢琴音域外的音按八度折回音域内（MIDI 0 还会和休止符撞车）
+    pitches = pitches.astype(np.int16)
+    low = pitches < PIANO_LOWEST_PITCH
+    pitches[low] += 12 * -((pitches[low] - PIANO_LOWEST_PITCH) // 12)
+    high = pitches > PIANO_HIGHEST_PITCH
+    pitches[high] -= 12 * -((PIANO_HIGHEST_PITCH - pitches[high]) // 12)
+    return pitches.astype(np.uint8)
+
+
+def split_midi_voices(starts, ends, pitches):
+    # 起止时刻都相同的音算一个和弦；一个音还在响时另一个音开始，就拆到
+    # 不同声部（各自成为一条音轨），每个声部内部不再重叠。
+    # 返回每个声部的音符下标；高音优先进声部0，一般就是旋律
+    sounding = np.nonzero(ends > starts)[0]
+    if not len(sounding):
+        return []
+    order = sounding[np.lexsort((-pitches[sounding].astype(np.int16),
+                                 starts[sounding]))]
+    sorted_starts, sorted_ends = starts[order], ends[order]
+
+    # 快速路径：同一起点的音一起结束、且都在下一个起点之前结束 —— 单声部
+    onsets, first_idx = np.unique(sorted_starts, return_index=True)
+    group_ends = np.maximum.reduceat(sorted_ends, first_idx)
+    if (np.array_equal(group_ends, np.minimum.reduceat(sorted_ends, first_idx))
+            and np.all(group_ends[:-1] <= onsets[1:])):
+        return [order]
+
+    voice_chords = []  # 每个声部最后一个和弦的 (起点, 终点)
+    note_voices = np.empty(len(order), dtype=np.intp)
+    for idx, chord in enumerate(zip(sorted_starts.tolist(),
+                                    sorted_ends.tolist())):
+        start = chord[0]
+        voice = next((v for v, last in enumerate(voice_chords) if last == chord),
+                     None)
+        if voice is None:
+            voice = next((v for v, last in enumerate(voice_chords)
+                          if last[1] <= start), None)
+        if voice is None:
+            if len(voice_chords) < MIDI_MAX_VOICES:
+                voice = len(voice_chords)
+                voice_chords.append(chord)
+            else:
+                # 声部用完：最早结束的声部让位，它还在响的音在这里截断
+                voice = min(range(len(voice_chords)),
+                            key=lambda v: voice_chords[v][1])
+        voice_chords[voice] = chord
+        note_voices[idx] = voice
+    return [order[note_voices == voice] for voice in range(len(voice_chords))]
+
+
+def midi_notes_to_score(starts, ends, pitches, division, tempo_map):
+    # 同一时刻开始的音合成和弦（最高音作主音），每个事件持续到下一个起点；
+    # 和弦全部结束后到下一个起点之间补休止符，开头的空白也补休止符
+    order = np.lexsort((-pitches.astype(np.int16), starts))
+    starts, ends, pitches = starts[order], ends[order], pitches[order]
+    onsets, first_idx, counts = np.unique(starts,
+                                          return_index=True,
+                                          return_counts=True)
+    group_ends = np.maximum.reduceat(ends, first_idx)
+    next_onsets = np.append(onsets[1:], group_ends[-1])
+    note_ends = np.minimum(group_ends, next_onsets)
+
+    rank = np.arange(len(starts)) - np.repeat(first_idx, counts)
+    chord_width = min(int(counts.max()), MIDI_MAX_CHORD_NOTES) - 1
+    chords = np.zeros((len(onsets), chord_width), dtype=np.uint8)
+    extra = (rank > 0) & (rank <= chord_width)
+    group_of_note = np.repeat(np.arange(len(onsets)), counts)
+    chords[group_of_note[extra], rank[extra] - 1] = pitches[extra]
+
+    rest_mask = note_ends < next_onsets
+    event_starts = np.concatenate((onsets, note_ends[rest_mask]))
+    event_pitches = np.concatenate(
+        (pitches[first_idx],
+         np.full(rest_mask.sum(), REST_PITCH, dtype=np.uint8)))
+    event_chords = np.concatenate(
+        (chords, np.zeros((rest_mask.sum(), chord_width), dtype=np.uint8)))
+    if onsets[0] > 0:
+        event_starts = np.append(0, event_starts)
+        event_pitches = np.append(np.uint8(REST_PITCH), event_pitches)
+        event_chords = np.concatenate(
+            (np.zeros((1, chord_width), dtype=np.uint8), event_chords))
+
+    # 休止符与下一个起点的顺序：起点相同时音符在前（零长休止符随后被丢弃）
+    order = np.argsort(event_starts, kind='stable')
+    event_starts = event_starts[order]
+    event_ends = np.append(event_starts[1:], group_ends[-1])
+    keep = event_ends > event_starts
+    return Score.from_arrays(
+        event_pitches[order][keep],
+        (event_ends[keep] - event_starts[keep]) / division,
+        event_chords[order][keep] if chord_width else None, tempo_map)
+
+
+def parse_midi(data):
+    if data[:4] != b"MThd" or len(data) < 14:
+        raise ValueError("不是标准MIDI文件（缺少MThd文件头）")
+    header_length = int.from_bytes(data[4:8], "big")
+    _, _, division = struct.unpack(">HHH", data[8:14])
+    if division & 0x8000:
+        raise ValueError("暂不支持SMPTE时间格式的MIDI文件")
+
+    tempo_ticks, tempo_values = array('q'), array('q')
+    note_tracks = []
+    pos = 8 + header_length
+    while pos + 8 <= len(data):
+        chunk_type = data[pos:pos + 4]
+        chunk_end = pos + 8 + int.from_bytes(data[pos + 4:pos + 8], "big")
+        pos += 8
+        if chunk_type == b"MTrk":
+            try:
+                starts, ends, pitches = parse_midi_track(
+                    data, pos, min(chunk_end, len(data)), tempo_ticks,
+                    tempo_values)
+            except (IndexError, KeyError):
+                raise ValueError(f"MIDI文件损坏：第{pos}字节起的音轨无法解析") from None
+            if starts:
+                note_tracks.append((starts, ends, pitches))
+        pos = chunk_end  # 未知类型的块直接跳过
+
+    # format 1 的速度表在第一条音轨里，对所有音轨生效；一拍 = 一个四分音符
+    tempo_order = np.argsort(np.frombuffer(tempo_ticks, dtype=np.int64),
+                             kind='stable')
+    tempo_beats = np.frombuffer(tempo_ticks, dtype=np.int64)[tempo_order] / division
+    tempo_bpms = 60e6 / np.frombuffer(tempo_values, dtype=np.int64)[tempo_order]
+    tempo_map = make_tempo_map([(0, 60e6 / MIDI_DEFAULT_TEMPO)] +
+                               list(zip(tempo_beats.tolist(),
+                                        tempo_bpms.tolist())))
+
+    scores = []
+    for starts, ends, pitches in note_tracks:
+        starts = np.frombuffer(starts, dtype=np.int64)
+        ends = np.frombuffer(ends, dtype=np.int64)
+        pitches = fold_midi_pitches(np.frombuffer(pitches, dtype=np.uint8))
+        # 同一音轨里有重叠的长音（如双手钢琴谱的伴奏）时拆成多条音轨，
+        # 每个音都按原长播放，而不是在下一个音起点处被截断
+        for voice in split_midi_voices(starts, ends, pitches):
+            scores.append(
+                midi_notes_to_score(starts[voice], ends[voice], pitches[voice],
+                                    division, tempo_map))
+    if not scores:
+        raise ValueError("MIDI文件中没有音符")
+    return scores
+
+
+def midi_varlen(value):
+    encoded = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        encoded.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(encoded)
+
+
+def midi_track_chunk(events):
+    return b"MTrk" + struct.pack(">I", len(events)) + events
+
+
+def score_to_midi_events(score, channel, division):
+    # 一拍 = 一个四分音符（速度由导出的速度事件决定）
+    ticks = np.rint(score.beats * division).astype(np.int64)
+    end_ticks = np.rint((score.beats + score.durations) * division).astype(
+        np.int64)
+    if 'chord' in score.events.dtype.names:
+        note_pitches = np.column_stack((score.pitches, score.events['chord']))
+    else:
+        note_pitches = score.pitches[:, None]
+    sounding = note_pitches != REST_PITCH
+    event_idx = np.nonzero(sounding)[0]
+    pitches = note_pitches[sounding]
+
+    # 同一tick先关后开，避免同音重复时被提前截断
+    count = len(pitches)
+    event_ticks = np.concatenate((end_ticks[event_idx], ticks[event_idx]))
+    event_kinds = np.concatenate((np.zeros(count, dtype=np.int64),
+                                  np.ones(count, dtype=np.int64)))
+    event_pitches = np.concatenate((pitches, pitches))
+    order = np.lexsort((event_kinds, event_ticks))
+
+    events = bytearray()
+    last_tick = 0
+    for tick, kind, pitch in zip(event_ticks[order].tolist(),
+                                 event_kinds[order].tolist(),
+                                 event_pitches[order].tolist()):
+        events += midi_varlen(tick - last_tick)
+        events += bytes(((0x90 if kind else 0x80) | channel, pitch,
+                         MIDI_EXPORT_VELOCITY if kind else 0))
+        last_tick = tick
+    events += b"\x00\xff\x2f\x00"
+    return bytes(events)
+
+
+def save_midi(tracks, midi_path, division=MIDI_EXPORT_DIVISION):
+    # format 1：第0轨只放速度表，之后每条音轨一个MTrk
+    tempo_track = bytearray()
+    last_tick = 0
+    for beat, bpm in tracks[0].tempo_map.tolist():
+        tick = int(round(beat * division))
+        tempo = min(int(round(60e6 / bpm)), 0xFFFFFF)  # 3字节上限
+        tempo_track += midi_varlen(tick - last_tick)
+        tempo_track += b"\xff\x51\x03" + tempo.to_bytes(3, "big")
+        last_tick = tick
+    tempo_track += b"\x00\xff\x2f\x00"
+    channels = [ch for ch in range(16) if ch != MIDI_DRUM_CHANNEL]
+    chunks = [midi_track_chunk(bytes(tempo_track))]
+    for idx, score in enumerate(tracks):
+        chunks.append(
+            midi_track_chunk(
+                score_to_midi_events(score, channels[idx % len(channels)],
+                                     division)))
+    header = b"MThd" + struct.pack(">IHHH", 6, 1, len(chunks), division)
+    with open(midi_path, "wb") as f:
+        f.write(header)
+        for chunk in chunks:
+            f.write(chunk)
+
+
+def export_command(argv):
+    parser = argparse.ArgumentParser(prog="main.py export",
+                                     description="把乐谱导出为MIDI文件")
+    parser.add_argument("score", nargs="?", default=DEFAULT_SCORE_PATH,
+                        help="乐谱文件或MIDI文件（默认 music/config.txt）")
+    parser.add_argument("-o", "--output", help="输出MIDI路径（默认与乐谱同名）")
+    args = parser.parse_args(argv)
+
+    midi_path = args.output or os.path.splitext(args.score)[0] + ".mid"
+    tracks = load_score(args.score)
+    save_midi(tracks, midi_path)
+    print(f"✅ 已导出 {midi_path}：{len(tracks)} 条音轨，"
+          f"{sum(len(score) for score in tracks)} 个音符")
+
+
+# ===================== 乐谱/PCM 磁盘缓存（按内容哈希寻址） =====================
+def score_content_hash(score_path, synth_settings):
+    # 乐谱内容 + 影响音频的合成参数，任一变化都需要重新渲染
+    digest = hashlib.sha256()
+    with open(score_path, "rb") as f:
+        digest.update(f.read())
+    # 音色按谐波表本身计入，而不只是名字：改了 TIMBRES 里的谐波或波表长度也要重新渲染
+    _, timbre, _ = synth_settings
+    digest.update(repr((SAMPLE_RATE, DEFAULT_TEMPO_BPM, synth_settings,
+                        TIMBRES[timbre], WAVETABLE_BITS)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def score_cache_dir(score_hash):
+    return os.path.join(SCORE_CACHE_DIR, f"v{SCORE_CACHE_VERSION}-{score_hash}")
+
+
+def load_score_cached(score_path=DEFAULT_SCORE_PATH):
+    # 返回 (音轨列表, 缓存的整曲PCM或None, 内容哈希)
+    score_hash = score_content_hash(score_path, current_synth_settings())
+    cache_dir = score_cache_dir(score_hash)
+    meta_path = os.path.join(cache_dir, "meta.json")
+    if SCORE_CACHE_ENABLED and os.path.exists(meta_path):
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            tempo_map = np.array([tuple(change) for change in meta['tempo']],
+                                 dtype=TEMPO_MAP_DTYPE)
+            tracks = [
+                Score(np.load(os.path.join(cache_dir, f"track_{idx}.npy")),
+                      tempo_map) for idx in range(meta['tracks'])
+            ]
+            pcm_path = os.path.join(cache_dir, "pcm.npy")
+            # 内存映射：不读入整曲，播放时按需换页
+            cached_pcm = np.load(pcm_path, mmap_mode='r') if os.path.exists(
+                pcm_path) else None
+            return tracks, cached_pcm, score_hash
+        except (OSError, ValueError, KeyError):
+            pass  # 缓存损坏：重新解析并覆盖
+
+    tracks = load_score(score_path)
+    if SCORE_CACHE_ENABLED:
+        try:
+            save_compiled_score(cache_dir, tracks)
+        except OSError:
+            pass  # 缓存目录不可写（如装在只读目录里）：不缓存，照常播放
+    return tracks, None, score_hash
+
+
+def save_compiled_score(cache_dir, tracks):
+    os.makedirs(cache_dir, exist_ok=True)
+    for idx, score in enumerate(tracks):
+        np.save(os.path.join(cache_dir, f"track_{idx}.npy"), score.events)
+    # meta.json 最后写入，存在即表示编译结果完整
+    meta_tmp_path = os.path.join(cache_dir, f"meta.json.{os.getpid()}.tmp")
+    with open(meta_tmp_path, "w", encoding="utf-8") as f:
+        json.dump({
+            'tracks': len(tracks),
+            'tempo': tracks[0].tempo_map.tolist(),
+        }, f)
+    os.replace(meta_tmp_path, os.path.join(cache_dir, "meta.json"))
+
+
+# ===================== 离线渲染（流式写入WAV，无需声卡） =====================
+def render_to_wav(tracks,
+                  wav_path,
+                  chunk_samples=STREAM_CHUNK_SAMPLES,
+                  workers=0):
+    start = time.perf_counter()
+    total_samples = 0
+    if workers is None or workers > 1:
+        # 多进程整曲合成后一次写盘（内存占用为整曲大小）
+        chunks = [render_score_parallel(tracks, workers)[0]]
+    else:
+        # 逐块写盘，内存占用与曲长无关
+        chunks = iter_score_chunks(tracks, chunk_samples)
+
+    with wave.open(wav_path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        for chunk in chunks:
+            wav_file.writeframes(chunk.astype("<i2", copy=False).tobytes())
+            total_samples += len(chunk)
+    render_time = time.perf_counter() - start
+
+    audio_time = total_samples / SAMPLE_RATE
+    realtime_factor = audio_time / render_time if render_time > 0 else float(
+        'inf')
+    return {
+        'output': wav_path,
+        'samples': total_samples,
+        'audio_seconds': audio_time,
+        'render_seconds': render_time,
+        'realtime_factor': realtime_factor,
+        'bytes': os.path.getsize(wav_path),
+    }
+
 
-    audio_thread = threading.Thread(target=audio_play_thread)
-    visual_thread = threading.Thread(target=staff_visual_thread)
+def render_command(argv):
+    parser = argparse.ArgumentParser(prog="main.py render",
+                                     description="把乐谱离线渲染为WAV文件")
+    parser.add_argument("score", nargs="?", default=DEFAULT_SCORE_PATH,
+                        help="乐谱文件或MIDI文件（默认 music/config.txt）")
+    parser.add_argument("-o", "--output", help="输出WAV路径（默认与乐谱同名）")
+    parser.add_argument("--chunk-samples", type=int,
+                        default=STREAM_CHUNK_SAMPLES, help="每次写盘的采样数")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="多进程合成的进程数（0=单进程流式写盘）")
+    args = parser.parse_args(argv)
 
-    audio_thread.start()
-    time.sleep(0.2)  # 稍等音频启动，确保同步
-    visual_thread.start()
+    wav_path = args.output or os.path.splitext(args.score)[0] + ".wav"
+    tracks = load_score(args.score)
+    stats = render_to_wav(tracks, wav_path, args.chunk_samples, args.workers)
+    print(f"✅ 已渲染 {stats['output']}：音频 {stats['audio_seconds']:.2f} 秒，"
+          f"耗时 {stats['render_seconds']:.3f} 秒，"
+          f"实时倍数 {stats['realtime_factor']:.0f}x")
 
-    audio_thread.join()
-    visual_thread.join()
+
+# ===================== 批量渲染（进程池 + 内容哈希跳过 + 清单） =====================
+BATCH_MANIFEST_NAME = "manifest.json"
+
+
+def render_batch_job(score_path, wav_path, synth_settings):
+    apply_synth_settings(synth_settings)
+    try:
+        stats = render_to_wav(load_score(score_path), wav_path)
+    except Exception as e:
+        return {'status': 'failed', 'error': f"{type(e).__name__}: {e}"}
+    stats['status'] = 'rendered'
+    return stats
+
+
+def render_batch(score_dir, output_dir, workers=None, pattern="*.txt"):
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, BATCH_MANIFEST_NAME)
+    previous_jobs = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            previous_jobs = {job['score']: job for job in json.load(f)['jobs']}
+
+    synth_settings = current_synth_settings()
+    jobs = []
+    for score_path in sorted(glob.glob(os.path.join(score_dir, pattern))):
+        score_name = os.path.basename(score_path)
+        wav_path = os.path.join(output_dir,
+                                os.path.splitext(score_name)[0] + ".wav")
+        jobs.append({
+            'score': score_name,
+            'output': wav_path,
+            'hash': score_content_hash(score_path, synth_settings),
+        })
+
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for job in jobs:
+            previous = previous_jobs.get(job['score'])
+            if (previous and previous.get('hash') == job['hash']
+                    and previous.get('status') in ('rendered', 'skipped')
+                    and os.path.exists(job['output'])):
+                # 内容未变且输出还在：沿用上次的统计，不再渲染
+                job.update({key: previous[key]
+                            for key in ('audio_seconds', 'render_seconds',
+                                        'bytes') if key in previous})
+                job['status'] = 'skipped'
+                continue
+            score_path = os.path.join(score_dir, job['score'])
+            futures[pool.submit(render_batch_job, score_path, job['output'],
+                                synth_settings)] = job
+
+        for future in concurrent.futures.as_completed(futures):
+            job = futures[future]
+            stats = future.result()
+            stats.pop('output', None)
+            stats.pop('samples', None)
+            job.update(stats)
+            print(f"  {'✅' if job['status'] == 'rendered' else '❌'} "
+                  f"{job['score']}" +
+                  (f"：{job['error']}" if job['status'] == 'failed' else
+                   f"（{job['audio_seconds']:.1f} 秒音频，"
+                   f"{job['render_seconds']:.3f} 秒渲染）"))
+    wall_time = time.perf_counter() - start
+
+    rendered_jobs = [job for job in jobs if job['status'] == 'rendered']
+    manifest = {
+        'sample_rate': SAMPLE_RATE,
+        'synth_settings': list(synth_settings),
+        'workers': workers or os.cpu_count(),
+        'wall_seconds': wall_time,
+        'rendered': len(rendered_jobs),
+        'skipped': sum(job['status'] == 'skipped' for job in jobs),
+        'failed': sum(job['status'] == 'failed' for job in jobs),
+        'rendered_audio_seconds': sum(job['audio_seconds']
+                                      for job in rendered_jobs),
+        'rendered_bytes': sum(job['bytes'] for job in rendered_jobs),
+        'jobs': jobs,
+    }
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+def batch_command(argv):
+    parser = argparse.ArgumentParser(prog="main.py batch",
+                                     description="批量渲染目录下的所有乐谱")
+    parser.add_argument("score_dir", help="乐谱目录")
+    parser.add_argument("-o", "--output-dir",
+                        help="输出目录（默认为乐谱目录下的 rendered/）")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="并行进程数（默认全部CPU核）")
+    parser.add_argument("--pattern", default="*.txt", help="乐谱文件匹配模式")
+    args = parser.parse_args(argv)
+
+    output_dir = args.output_dir or os.path.join(args.score_dir, "rendered")
+    manifest = render_batch(args.score_dir, output_dir, args.workers,
+                            args.pattern)
+    print(f"✅ 批量渲染完成：渲染 {manifest['rendered']}，"
+          f"跳过 {manifest['skipped']}，失败 {manifest['failed']}，"
+          f"用时 {manifest['wall_seconds']:.2f} 秒 → "
+          f"{os.path.join(output_dir, BATCH_MANIFEST_NAME)}")
+
+
+# 命令行子命令：python music/main.py <命令> ...（不带命令则直接播放）
+COMMANDS = {
+    'render': render_command,
+    'batch': batch_command,
+    'export': export_command,
+}
+
+
+# ===================== 主控制（原功能） =====================
+def load_playback_state(score_path, title=""):
+    return PlaybackState(*load_score_cached(score_path), title=title)
+
+
+def playlist_title(score_path, song_idx, song_count):
+    return f"第{song_idx + 1}/{song_count}首 {os.path.basename(score_path)}"
+
+
+async def queue_next_song(player, pending, skipped):
+    # 当前曲目开播后在后台解析下一首并排进播放器（合成线程空闲时预先合成）。
+    # 同一时间只排一首：内存里最多是正在播的和下一首两份整曲PCM
+    while pending:
+        score_path, title = pending.pop(0)
+        try:
+            state = await asyncio.to_thread(load_playback_state, score_path,
+                                            title)
+            timeline = await asyncio.to_thread(playback_timeline, state)
+        except (OSError, SyntaxError, ValueError) as e:
+            skipped.append((score_path, e))  # 坏掉的乐谱跳过，播完再提示
+            continue
+        player.queue_next(timeline, state.clock, more_songs=bool(pending))
+        return state, timeline
+    player.end_of_playlist()
+    return None
+
+
+async def play_song(state, player, with_typewriter):
+    # 画一首歌的五线谱/进度（第一首还有打字机），到这首的时钟结束为止
+    state.bind_loop()
+    state.set_playing(True)
+    tasks = [asyncio.create_task(staff_task(state))]
+    if with_typewriter:
+        tasks.append(asyncio.create_task(typewriter_task(state)))
+    try:
+        with KeyboardInput(make_key_handler(state, player)):
+            await note_sync_task(state)
+    finally:
+        state.set_playing(False)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def play_music_with_staff(state, next_score_paths=(), skipped=None,
+                                backend=None, latency=STREAM_LATENCY_SECONDS):
+    # next_score_paths 非空即播放列表：各曲首尾相接，只在开头显示一次开始提示。
+    # backend 为音频输出后端（默认声卡），播放结束时关闭；返回输出缓冲区的统计
+    song_count = len(next_score_paths) + 1
+    pending = [(path, playlist_title(path, song_idx, song_count))
+               for song_idx, path in enumerate(next_score_paths, 1)]
+    skipped = [] if skipped is None else skipped
+    first_state = state
+    timeline = playback_timeline(state)
+    player = StreamPlayer(timeline,
+                          latency,
+                          clock=state.clock,
+                          backend=backend,
+                          render_first=not STREAM_PLAYBACK)
+    if pending:
+        player.expect_next()
+    next_song = None
+    try:
+        # 等到第一个采样真正送进声卡再开始画（阻塞调用放到线程池）
+        await asyncio.to_thread(player.start)
+        while True:
+            next_song = (asyncio.create_task(
+                queue_next_song(player, pending, skipped))
+                         if pending else None)
+            await play_song(state, player, state is first_state)
+            if next_song is None:
+                break
+            queued = await next_song
+            if queued is None:
+                break
+            # 送声线程已切到下一首：释放上一首的整曲PCM（或写进缓存）
+            await asyncio.to_thread(timeline.close)
+            state, timeline = queued
+        await asyncio.to_thread(player.wait_done)
+    finally:
+        # 正常结束或 Ctrl+C（取消）都走这里：先停声音，再收起后台任务
+        player.stop()
+        if next_song is not None and not next_song.done():
+            next_song.cancel()
+            await asyncio.gather(next_song, return_exceptions=True)
+        await asyncio.to_thread(player.close)
+
+    # 播放结束提示
+    draw_typewriter_lines(first_state.typed_lines, state.term_width)
+    draw_end_message(state.term_width)
+    await asyncio.sleep(4)  # 延长停留时间，方便查看
+    return player.metrics()
+
+
+def start_music_with_staff(state, next_score_paths=(), backend=None,
+                           latency=STREAM_LATENCY_SECONDS):
+    skipped = []
+    metrics = asyncio.run(
+        play_music_with_staff(state, next_score_paths, skipped, backend,
+                              latency))
+    # 光标移到画面最下方，提示输出缓冲区统计和被跳过的乐谱
+    sys.stdout.write(f"\033[{fixed_lines['border_bottom'] + 1};1H")
+    print(f"📊 输出缓冲：容量 {metrics['latency_seconds']:.2f} 秒，"
+          f"最低水位 {metrics['low_water_seconds']:.2f} 秒，"
+          f"下溢 {metrics['underruns']} 次")
+    for score_path, e in skipped:
+        print(f"⚠️ 已跳过 {score_path}：{e}")
+    runtime_stats.set_value('output_buffer', metrics)
+    runtime_stats.set_value('note_cache', note_wave_cache.stats())
+    return metrics
+
+
+def parse_play_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="main.py", description="播放乐谱（五线谱 + 打字机画面）")
+    parser.add_argument("scores", nargs="*", default=[DEFAULT_SCORE_PATH],
+                        help="乐谱文件或MIDI文件，多个则按顺序连续播放")
+    parser.add_argument("--audio", choices=AUDIO_BACKENDS,
+                        default="simpleaudio",
+                        help="音频输出：声卡 / 无声（按实时速率空播）/ 写WAV文件")
+    parser.add_argument("--audio-output", default=DEFAULT_PLAYBACK_WAV_PATH,
+                        help="--audio wav 的输出路径")
+    parser.add_argument("--latency", type=float,
+                        default=STREAM_LATENCY_SECONDS,
+                        help="合成与输出之间的缓冲时长（秒），出现下溢就调大")
+    parser.add_argument("--stats", metavar="JSON",
+                        help="记录运行时统计，退出或收到 SIGUSR1 时写入该文件")
+    return parser.parse_args(argv)
 
 
 # ===================== 程序入口 =====================
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # PyInstaller 打包后子进程需要
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        # 子命令不占用终端画面，出错直接打印原因
+        try:
+            COMMANDS[sys.argv[1]](sys.argv[2:])
+        except FileNotFoundError as e:
+            sys.exit(f"❌ 未找到文件：{e.filename}")
+        except SyntaxError as e:
+            sys.exit(f"❌ 乐谱格式错误（{e.filename} 第{e.lineno}行第{e.offset}列）："
+                     f"{e.msg}\n   正确示例：('C4', 1)（英文符号）")
+        except ValueError as e:
+            sys.exit(f"❌ 乐谱错误：{e}")
+        except KeyboardInterrupt:
+            sys.exit("\n🛑 程序已手动停止")
+        sys.exit(0)
+
     try:
         # 步骤1：打印代码（可选，不影响主功能）
         # print_code_character_by_character()
 
-        # 步骤2：读取乐谱
-        with open("music/config.txt", "r", encoding="utf-8") as f:
-            music_notes = [
-                eval(line.strip()) for line in f.readlines()
-                if line.strip() and line.strip().startswith("(")
-            ]
-
-        # 校验乐谱
-        valid_notes = set(NOTE_POSITION_MAP.keys())
-        for idx, (note_code, dur) in enumerate(music_notes):
-            if note_code not in valid_notes:
-                raise ValueError(f"第{idx+1}行：未知音符「{note_code}」")
-            if not isinstance(dur, (int, float)) or dur <= 0:
-                raise ValueError(f"第{idx+1}行：时长必须为正数")
+        # 步骤2：读取并校验乐谱
+        # python music/main.py [乐谱路径 ...] [--audio null|wav]，支持 .txt 乐谱和
+        # .mid 文件；给多个路径即按顺序连续播放，后面的曲目边播边在后台准备。
+        # 没有声卡的机器（CI、渲染机）用 --audio null / wav 也能跑完整个播放流程
+        play_args = parse_play_args(sys.argv[1:])
+        score_paths = play_args.scores
+        if play_args.stats:
+            runtime_stats.enable(play_args.stats)
+        for score_path in score_paths[1:]:
+            if not os.path.isfile(score_path):
+                raise FileNotFoundError(errno.ENOENT, "未找到乐谱", score_path)
+        playback_state = load_playback_state(
+            score_paths[0],
+            playlist_title(score_paths[0], 0, len(score_paths))
+            if len(score_paths) > 1 else "")
+        audio_backend = make_audio_backend(play_args.audio,
+                                           play_args.audio_output)
 
         # 步骤3：显示开始提示
-        show_start_prompt()
+        show_start_prompt(playback_state.term_width)
 
         # 步骤4：清空终端并启动
         clear_terminal()
-        start_music_with_staff()
+        start_music_with_staff(playback_state, score_paths[1:], audio_backend,
+                               play_args.latency)
 
-    except FileNotFoundError:
+    except FileNotFoundError as e:
         clear_terminal()
-        print("❌ 未找到 music/config.txt 文件")
+        print(f"❌ 未找到 {e.filename} 文件")
         print("   解决方案：在程序同级目录创建「music」文件夹，放入「config.txt」乐谱")
-    except SyntaxError:
+    except SyntaxError as e:
         clear_terminal()
-        print("❌ config.txt 格式错误！正确示例：('C4', 1)（英文符号）")
+        print(f"❌ {os.path.basename(e.filename or DEFAULT_SCORE_PATH)} "
+              f"格式错误（第{e.lineno}行第{e.offset}列）：{e.msg}")
+        print("   正确示例：('C4', 1)（英文符号）")
     except ValueError as e:
         clear_terminal()
         print(f"❌ 乐谱错误：{e}")
@@ -589,4 +3116,5 @@ if __name__ == "__main__":
     except Exception as e:
         clear_terminal()
         print(f"❌ 运行错误：{e}")
-        print("   建议：重新安装依赖 → pip install numpy simpleaudio")
+        print("   建议：重新安装依赖 → pip install numpy simpleaudio"
+              "（没有声卡可加 --audio null）")